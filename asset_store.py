@@ -0,0 +1,108 @@
+"""Content-addressed store for level assets (block images, backgrounds).
+
+Every file is kept once as <root>/assets/<sha256><ext>, whatever it was called
+when it was imported, so two different images with the same name never
+collide and one image used by many levels is stored once. Level files name
+their assets by reference, the store-relative path "assets/<sha256><ext>",
+which resolves against the level's directory like the plain file names of
+older levels. The name a file was imported under is kept next to it in
+<root>/assets/names/<sha256>.txt for display.
+"""
+import hashlib
+import os
+
+import level_format
+
+ASSET_DIR = "assets"
+THUMB_DIR = "thumbs"
+NAME_DIR = "names"
+CHUNK_SIZE = 1 << 20
+
+# (absolute path, size, mtime) -> sha256 hex, so unchanged files are hashed once
+_hash_cache = {}
+
+
+def file_hash(path):
+    """Returns the sha256 hex digest of a file."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    digest = _hash_cache.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(block)
+        digest = _hash_cache[key] = sha.hexdigest()
+    return digest
+
+
+def ref_for(path):
+    """The reference a file gets in the store (the file is not copied)."""
+    return f"{ASSET_DIR}/{file_hash(path)}{os.path.splitext(path)[1].lower()}"
+
+
+def digest_of(ref):
+    return os.path.splitext(ref[len(ASSET_DIR) + 1:])[0]
+
+
+def _copy_checked(src, dst, digest):
+    """Copies src to dst, raising ValueError if the copied bytes do not hash to digest."""
+    sha = hashlib.sha256()
+    for block in iter(lambda: src.read(CHUNK_SIZE), b""):
+        sha.update(block)
+        dst.write(block)
+    if sha.hexdigest() != digest:
+        raise ValueError(f"{src.name} no longer matches its reference {digest}")
+
+
+def import_asset(path, root, ref=None):
+    """Adds a file to the store under root unless it is already there; returns its reference.
+
+    ref is the reference the file was given earlier (by default it is hashed
+    now). The copy is checked against it, so a file that changed since then
+    raises ValueError instead of being stored under a hash it does not have.
+    """
+    if ref is None:
+        ref = ref_for(path)
+    target = os.path.join(root, ref)
+    if not os.path.exists(target):
+        with open(path, "rb") as src:
+            level_format.write_atomic(target, lambda dst: _copy_checked(src, dst, digest_of(ref)))
+    # Files opened from the store itself only know their hash, not their name
+    name = os.path.basename(path)
+    name_file = name_path(root, digest_of(ref))
+    if name != os.path.basename(ref) and not os.path.exists(name_file):
+        level_format.write_atomic(name_file, lambda dst: dst.write(name.encode("utf-8")))
+    return ref
+
+
+def locate(name, *roots):
+    """Finds an asset reference or plain file name in the first root that has it."""
+    for root in roots:
+        path = os.path.join(root, name)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def name_path(root, digest):
+    """Where the name an asset was imported under is kept."""
+    return os.path.join(root, ASSET_DIR, NAME_DIR, f"{digest}.txt")
+
+
+def display_name(name, *roots):
+    """The original file name of an asset reference, or the base name of a plain file name."""
+    if name.startswith(ASSET_DIR + "/"):
+        for root in roots:
+            try:
+                with open(name_path(root, digest_of(name)), encoding="utf-8") as f:
+                    return f.read()
+            except OSError:
+                continue
+    return os.path.basename(name)
+
+
+def thumbnail_path(root, digest, size):
+    """Where the decoded thumbnail of an asset at the given size is cached."""
+    return os.path.join(root, ASSET_DIR, THUMB_DIR, f"{digest}_{size}.png")
@@ -5,8 +5,20 @@ import os
 import shutil
 import sys
 import io
+import base64
+import gzip
+import zlib
+import queue
+import threading
+import time
 import xml.etree.ElementTree as ET
-from shutil import copyfile
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import asset_store
+import level_format
 
 # Set console output encoding to UTF-8
 if sys.platform == 'win32':
@@ -15,21 +27,601 @@ if sys.platform == 'win32':
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
 
 SAVE_FOLDER = "level_data"
+# Автосохранение: чанки по AUTOSAVE_CHUNK x AUTOSAVE_CHUNK клеток, раз в AUTOSAVE_MS мс.
+# Автосохранение прошлого сеанса при запуске переносится в AUTOSAVE_PREV_FOLDER
+AUTOSAVE_FOLDER = os.path.join(SAVE_FOLDER, "autosave")
+AUTOSAVE_PREV_FOLDER = os.path.join(SAVE_FOLDER, "autosave.prev")
+AUTOSAVE_CHUNK = 16
+AUTOSAVE_MS = 30000
 BLOCK_SIZE = 64
 # Canvas size
 CANVAS_WIDTH = 1800
 CANVAS_HEIGHT = 1200
+# Слои TMX собираются в изображения-чанки примерно такого размера (в пикселях);
+# собранных чанков, ушедших из видимой области, хранится не больше TMX_CHUNK_CACHE
+TMX_CHUNK_PX = 1024
+TMX_CHUNK_CACHE = 24
+# Элементы холста создаются только для видимой области плюс такой запас (в пикселях)
+VIEW_MARGIN = 4 * BLOCK_SIZE
+# Потоки для декодирования изображений и как часто Tk забирает их результаты (мс)
+LOADER_THREADS = min(4, os.cpu_count() or 1)
+LOADER_POLL_MS = 30
+# Движение мыши при перетаскивании и панорамировании обрабатывается не чаще раза за кадр (мс)
+MOTION_FRAME_MS = 16
+# Фон замощается сеткой BG_TILES_X x BG_TILES_Y; готовых фонов в кэше не больше BG_CACHE_SIZE
+BG_TILES_X = 8
+BG_TILES_Y = 5
+BG_CACHE_SIZE = 4
+# Сколько шагов отмены хранит журнал правок
+HISTORY_LIMIT = 500
+# Флаги отражения в старших битах gid (формат TMX)
+FLIPPED_HORIZONTALLY = 0x80000000
+FLIPPED_VERTICALLY = 0x40000000
+FLIPPED_DIAGONALLY = 0x20000000
+GID_MASK = 0x0FFFFFFF
+
+# Кэши внешних тайлсетов (.tsx) и изображений тайлсетов: путь -> данные
+_tsx_cache = {}
+_tileset_image_cache = {}
+# Готовые фоны: (путь, mtime, размер холста) -> изображение, в порядке LRU
+_background_cache = OrderedDict()
+_background_lock = threading.Lock()
+
+
+def decode_csv_layer(text):
+    """Разбирает CSV-данные слоя TMX в плоский массив gid за один проход"""
+    return array('I', [int(value) for value in text.replace('\n', ',').split(',') if value.strip()])
+
+
+def decode_layer_data(data):
+    """Декодирует <data> слоя TMX (csv, base64 с zlib/gzip/zstd или XML) в массив gid"""
+    encoding = data.get('encoding')
+    compression = data.get('compression')
+    if encoding == 'csv':
+        return decode_csv_layer(data.text)
+    if encoding == 'base64':
+        raw = base64.b64decode(data.text.strip())
+        if compression == 'zlib':
+            raw = zlib.decompress(raw)
+        elif compression == 'gzip':
+            raw = gzip.decompress(raw)
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("для слоёв со сжатием zstd нужен пакет zstandard")
+            raw = zstandard.ZstdDecompressor().decompressobj().decompress(raw)
+        elif compression:
+            raise ValueError(f"неизвестное сжатие слоя: {compression}")
+        # gid хранятся как 32-битные числа little-endian
+        gids = array('I')
+        gids.frombytes(raw)
+        if sys.byteorder == 'big':
+            gids.byteswap()
+        return gids
+    if encoding is None:
+        return array('I', [int(tile.get('gid', 0)) for tile in data.findall('tile')])
+    raise ValueError(f"неизвестная кодировка слоя: {encoding}")
+
+
+def load_tsx(tsx_path):
+    """Разбирает внешний тайлсет .tsx один раз и возвращает его корневой элемент"""
+    tsx_path = os.path.abspath(tsx_path)
+    mtime = os.path.getmtime(tsx_path)
+    cached = _tsx_cache.get(tsx_path)
+    if cached is None or cached[0] != mtime:
+        cached = _tsx_cache[tsx_path] = (mtime, ET.parse(tsx_path).getroot())
+    return cached[1]
+
+
+def load_tileset_image(image_path):
+    """Открывает изображение тайлсета один раз (повторно только если файл изменился)"""
+    image_path = os.path.abspath(image_path)
+    mtime = os.path.getmtime(image_path)
+    cached = _tileset_image_cache.get(image_path)
+    if cached is None or cached[0] != mtime:
+        cached = _tileset_image_cache[image_path] = (mtime, Image.open(image_path).convert('RGBA'))
+    return cached[1]
+
+
+def resolve_tilesets(root, tmx_path):
+    """Возвращает список (firstgid, изображение) для встроенных и внешних тайлсетов карты"""
+    tilesets = []
+    for tileset in root.findall('tileset'):
+        firstgid = int(tileset.get('firstgid'))
+        base_dir = os.path.dirname(tmx_path)
+        source = tileset.get('source')
+        if source:
+            tsx_path = os.path.join(base_dir, source)
+            tileset = load_tsx(tsx_path)
+            base_dir = os.path.dirname(tsx_path)
+        image = tileset.find('image')
+        if image is not None:
+            tilesets.append((firstgid, load_tileset_image(os.path.join(base_dir, image.get('source')))))
+    return tilesets
+
+
+def crop_tiles(tilesets, gids, tile_width, tile_height):
+    """Вырезает каждый используемый тайл один раз: gid -> изображение.
+
+    tilesets — список (firstgid, изображение тайлсета), gid относится к
+    тайлсету с наибольшим firstgid, не превышающим его.
+    """
+    tilesets = sorted(tilesets, key=lambda t: t[0], reverse=True)
+    tiles = {}
+    for gid in set(gids):
+        base_gid = gid & GID_MASK
+        if base_gid == 0:  # 0 означает пустой тайл
+            continue
+        tile = tiles.get(base_gid)
+        if tile is None:
+            for firstgid, tileset_img in tilesets:
+                if base_gid >= firstgid:
+                    tile_id = base_gid - firstgid
+                    cols = tileset_img.width // tile_width
+                    if cols and tile_id < cols * (tileset_img.height // tile_height):
+                        tile_x = (tile_id % cols) * tile_width
+                        tile_y = (tile_id // cols) * tile_height
+                        tile = tileset_img.crop((tile_x, tile_y, tile_x + tile_width, tile_y + tile_height))
+                        tiles[base_gid] = tile
+                    break
+        if tile is None or gid == base_gid:
+            continue
+        # Отражения: сначала по диагонали, затем по горизонтали и вертикали
+        if gid & FLIPPED_DIAGONALLY:
+            tile = tile.transpose(Image.Transpose.TRANSPOSE)
+        if gid & FLIPPED_HORIZONTALLY:
+            tile = tile.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+        if gid & FLIPPED_VERTICALLY:
+            tile = tile.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+        tiles[gid] = tile
+    return tiles
+
+
+def layer_chunks(gids, map_width, map_height, tile_width, tile_height, tiles):
+    """Делит слой на чанки, не собирая изображений.
+
+    Возвращает список (x, y, ширина, высота, функция сборки) для непустых
+    чанков; изображение чанка собирается, только когда чанк становится видим.
+    """
+    chunk_cols = max(1, TMX_CHUNK_PX // tile_width)
+    chunk_rows = max(1, TMX_CHUNK_PX // tile_height)
+    chunks = []
+    for chunk_y in range(0, map_height, chunk_rows):
+        rows = min(chunk_rows, map_height - chunk_y)
+        for chunk_x in range(0, map_width, chunk_cols):
+            cols = min(chunk_cols, map_width - chunk_x)
+            # Пустой ли чанк, проверяем срезами строк, без обхода клеток в Python
+            if all(tiles.keys().isdisjoint(gids[y * map_width + chunk_x:y * map_width + chunk_x + cols])
+                   for y in range(chunk_y, chunk_y + rows)):
+                continue
+            compose = partial(compose_chunk, gids, map_width, chunk_x, chunk_y, cols, rows,
+                              tile_width, tile_height, tiles)
+            chunks.append((chunk_x * tile_width, chunk_y * tile_height, cols * tile_width, rows * tile_height, compose))
+    return chunks
+
+
+def compose_chunk(gids, map_width, chunk_x, chunk_y, cols, rows, tile_width, tile_height, tiles):
+    """Собирает изображение одного чанка слоя из вырезанных тайлов"""
+    image = Image.new('RGBA', (cols * tile_width, rows * tile_height))
+    for y in range(rows):
+        row_start = (chunk_y + y) * map_width + chunk_x
+        for x, gid in enumerate(gids[row_start:row_start + cols]):
+            tile = tiles.get(gid)
+            if tile is not None:
+                image.paste(tile, (x * tile_width, y * tile_height))
+    return image
+
+
+def decode_block_image(path):
+    """Открывает и масштабирует изображение блока (выполняется в рабочем потоке)"""
+    img = Image.open(path)
+    return img.resize((BLOCK_SIZE, BLOCK_SIZE), Image.Resampling.LANCZOS)
+
+
+def decode_block(path):
+    """Хэширует и декодирует блок (выполняется в рабочем потоке).
+
+    Возвращает (ссылка на ресурс, изображение). Миниатюра BLOCK_SIZE хранится
+    в хранилище ресурсов по хэшу, поэтому один и тот же блок из разных
+    уровней декодируется из исходника только один раз.
+    """
+    ref = asset_store.ref_for(path)
+    thumb_path = asset_store.thumbnail_path(SAVE_FOLDER, asset_store.digest_of(ref), BLOCK_SIZE)
+    if os.path.exists(thumb_path):
+        with Image.open(thumb_path) as thumb:
+            return ref, thumb.copy()
+    
+    img = decode_block_image(path)
+    try:
+        level_format.write_atomic(thumb_path, lambda dst: img.save(dst, 'PNG'))
+    except OSError as e:
+        print(f"⚠️ Не удалось сохранить миниатюру: {str(e)}")
+    return ref, img
+
+
+def build_background(path, size=(CANVAS_WIDTH, CANVAS_HEIGHT)):
+    """Замощает фон сразу в размере холста (выполняется в рабочем потоке).
+
+    Плитка масштабируется один раз до 1/8 x 1/5 холста и копируется по сетке,
+    поэтому промежуточное изображение в 40 исходных плиток не создаётся.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.path.getmtime(path), size)
+    with _background_lock:
+        if key in _background_cache:
+            _background_cache.move_to_end(key)
+            return _background_cache[key]
+    
+    width, height = size
+    # Границы плиток округляются, чтобы сетка точно покрыла холст без щелей
+    xs = [round(i * width / BG_TILES_X) for i in range(BG_TILES_X + 1)]
+    ys = [round(j * height / BG_TILES_Y) for j in range(BG_TILES_Y + 1)]
+    tile_size = (max(b - a for a, b in zip(xs, xs[1:])), max(b - a for a, b in zip(ys, ys[1:])))
+    
+    with Image.open(path) as original_img:
+        tile = original_img.convert('RGBA')
+    tile = tile.resize(tile_size, Image.Resampling.LANCZOS)
+    
+    tiled_img = Image.new('RGBA', size)
+    for x in xs[:-1]:
+        for y in ys[:-1]:
+            tiled_img.paste(tile, (x, y))
+    
+    with _background_lock:
+        # Старые версии того же файла и давно не использованные фоны вытесняются
+        for old_key in [k for k in _background_cache if k[0] == path and k[2] == size]:
+            del _background_cache[old_key]
+        _background_cache[key] = tiled_img
+        while len(_background_cache) > BG_CACHE_SIZE:
+            _background_cache.popitem(last=False)
+    return tiled_img
 
 
-def snap_to_grid(x, y):
-    """Привязка к сетке"""
-    x = max(BLOCK_SIZE // 2, min(CANVAS_WIDTH - BLOCK_SIZE // 2, x))
-    y = max(BLOCK_SIZE // 2, min(CANVAS_HEIGHT - BLOCK_SIZE // 2, y))
+def decode_tmx(tmx_path):
+    """Разбирает карту .tmx и делит её слои на чанки (выполняется в рабочем потоке).
+
+    Возвращает список чанков из layer_chunks в порядке отрисовки; изображения
+    чанков собираются позже, по мере появления в видимой области.
+    """
+    # Парсим XML файл
+    root = ET.parse(tmx_path).getroot()
+    
+    # Получаем размеры карты
+    map_width = int(root.get('width'))
+    map_height = int(root.get('height'))
+    tile_width = int(root.get('tilewidth'))
+    tile_height = int(root.get('tileheight'))
+    
+    # Тайлсеты (встроенные и внешние .tsx) загружаются один раз на карту
+    try:
+        tilesets = resolve_tilesets(root, tmx_path)
+    except Exception as e:
+        raise ValueError(f"Не удалось загрузить тайлсет: {str(e)}")
+    
+    # Декодируем все видимые слои (включая вложенные в группы) по порядку отрисовки
+    layers = []
+    for layer in root.iter('layer'):
+        data = layer.find('data')
+        if data is not None and layer.get('visible') != '0':
+            layers.append(decode_layer_data(data))
+    
+    if not layers:
+        raise ValueError("Не удалось найти данные тайлов в файле")
+    
+    # Каждый уникальный тайл (с учётом отражений) вырезаем один раз
+    all_gids = set()
+    for gids in layers:
+        all_gids.update(gids)
+    tiles = crop_tiles(tilesets, all_gids, tile_width, tile_height)
+    
+    chunks = []
+    for gids in layers:
+        chunks.extend(layer_chunks(gids, map_width, map_height, tile_width, tile_height, tiles))
+    return chunks
+
+
+class LoadJob:
+    """Группа задач в пуле потоков с общим прогрессом и отменой"""
+
+    def __init__(self, title, total, on_result, on_done, on_error):
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.cancelled = False
+        self.futures = []
+        self.on_result = on_result  # (ключ, результат) — в потоке Tk
+        self.on_done = on_done      # (задача) — в потоке Tk, когда всё готово
+        self.on_error = on_error    # (ключ, исключение) — в потоке Tk
+
+
+def cell_of(x, y):
+    """Клетка сетки (столбец, строка), в которую попадает точка"""
+    return int(x) // BLOCK_SIZE, int(y) // BLOCK_SIZE
+
+
+def chunk_of(cell):
+    """Чанк автосохранения, в который попадает клетка сетки"""
+    return cell[0] // AUTOSAVE_CHUNK, cell[1] // AUTOSAVE_CHUNK
+
+
+def write_autosave(folder, chunks, assets, full=False):
+    """Записывает изменённые чанки автосохранения (выполняется в рабочем потоке).
+
+    chunks — {чанк: Level}, пустой Level удаляет файл чанка; assets — пары
+    (путь файла, ссылка или None), которые добавляются в общее хранилище
+    ресурсов SAVE_FOLDER. Файл, изменившийся после загрузки, сохраняется под
+    новым хэшем, и чанки ссылаются на него.
+    При full после записи удаляются файлы чанков, которых нет в chunks, —
+    до этого на диске остаётся прежнее полное автосохранение.
+    """
+    renamed = {}
+    for path, ref in assets:
+        try:
+            asset_store.import_asset(path, SAVE_FOLDER, ref)
+        except ValueError:
+            renamed[ref] = asset_store.import_asset(path, SAVE_FOLDER)
+    os.makedirs(folder, exist_ok=True)
+    written = set()
+    for (cx, cy), level in chunks.items():
+        name = f"chunk_{cx}_{cy}{level_format.EXTENSION}"
+        path = os.path.join(folder, name)
+        if len(level):
+            level.palette = [renamed.get(ref, ref) for ref in level.palette]
+            level.background = renamed.get(level.background, level.background)
+            level_format.save_level(path, level)
+            written.add(name)
+        elif os.path.exists(path):
+            os.remove(path)
+    if full:
+        for name in os.listdir(folder):
+            if name.startswith("chunk_") and name.endswith(level_format.EXTENSION) and name not in written:
+                os.remove(os.path.join(folder, name))
+
+
+def rotate_autosave(folder, prev_folder):
+    """Переносит автосохранение прошлого сеанса в prev_folder.
+
+    Первая запись сеанса удаляет чужие файлы чанков, поэтому данные для
+    восстановления после сбоя убираются в сторону до неё. Пустая папка не
+    переносится, чтобы не затереть прошлое prev_folder.
+    """
+    if not os.path.isdir(folder) or not any(
+            name.startswith("chunk_") and name.endswith(level_format.EXTENSION) for name in os.listdir(folder)):
+        return
+    if os.path.isdir(prev_folder):
+        shutil.rmtree(prev_folder)
+    os.replace(folder, prev_folder)
+
+
+def snap_to_grid(x, y, width=CANVAS_WIDTH, height=CANVAS_HEIGHT):
+    """Привязка к сетке в пределах области width x height"""
+    x = max(BLOCK_SIZE // 2, min(width - BLOCK_SIZE // 2, x))
+    y = max(BLOCK_SIZE // 2, min(height - BLOCK_SIZE // 2, y))
     snapped_x = (x // BLOCK_SIZE) * BLOCK_SIZE + BLOCK_SIZE // 2
     snapped_y = (y // BLOCK_SIZE) * BLOCK_SIZE + BLOCK_SIZE // 2
     return snapped_x, snapped_y
 
 
+class ObjectStore:
+    """Колоночное хранилище размещённых блоков.
+
+    Координаты и id элементов холста лежат в массивах int, блок хранится как
+    номер в палитре имён, а индекс сетки (клетка -> номер объекта) даёт
+    поиск за O(1). Удаление переносит последний объект на место удалённого.
+    Чанки, где что-то менялось, копятся в dirty для автосохранения.
+    """
+
+    def __init__(self):
+        self.cells = {}
+        self.dirty = set()            # чанки (см. chunk_of), изменённые после автосохранения
+        self.clear()
+
+    def clear(self):
+        self.dirty.update(chunk_of(cell) for cell in self.cells)
+        self.xs = array('i')
+        self.ys = array('i')
+        self.canvas_ids = array('i')  # 0 — элемент на холсте не создан
+        self.blocks = array('H')      # номер имени блока в self.palette
+        self.palette = []
+        self.palette_ids = {}         # имя блока -> номер в палитре
+        self.cells = {}               # клетка сетки -> номер объекта
+
+    def __len__(self):
+        return len(self.xs)
+
+    def palette_id(self, block_name):
+        block_id = self.palette_ids.get(block_name)
+        if block_id is None:
+            block_id = self.palette_ids[block_name] = len(self.palette)
+            self.palette.append(block_name)
+        return block_id
+
+    def add(self, x, y, block_name, canvas_id=0):
+        """Добавляет объект и возвращает его номер"""
+        index = len(self.xs)
+        self.xs.append(int(x))
+        self.ys.append(int(y))
+        self.canvas_ids.append(canvas_id)
+        self.blocks.append(self.palette_id(block_name))
+        cell = cell_of(x, y)
+        self.cells[cell] = index
+        self.dirty.add(chunk_of(cell))
+        return index
+
+    def remove(self, index):
+        """Удаляет объект за O(1) и возвращает (x, y, имя блока, id на холсте)"""
+        removed = (self.xs[index], self.ys[index], self.palette[self.blocks[index]], self.canvas_ids[index])
+        cell = cell_of(removed[0], removed[1])
+        if self.cells.get(cell) == index:
+            del self.cells[cell]
+        self.dirty.add(chunk_of(cell))
+        last = len(self.xs) - 1
+        if index != last:
+            for column in (self.xs, self.ys, self.canvas_ids, self.blocks):
+                column[index] = column[last]
+            last_cell = cell_of(self.xs[index], self.ys[index])
+            if self.cells.get(last_cell) == last:
+                self.cells[last_cell] = index
+        for column in (self.xs, self.ys, self.canvas_ids, self.blocks):
+            del column[last]
+        return removed
+
+    def add_many(self, positions, block_name):
+        """Добавляет объекты одного блока массивами за один проход; возвращает их номера"""
+        start = len(self.xs)
+        self.xs.extend(array('i', [int(x) for x, _ in positions]))
+        self.ys.extend(array('i', [int(y) for _, y in positions]))
+        self.canvas_ids.extend(array('i', bytes(4 * len(positions))))
+        self.blocks.extend(array('H', [self.palette_id(block_name)]) * len(positions))
+        cells = [cell_of(x, y) for x, y in positions]
+        self.cells.update(zip(cells, range(start, len(self.xs))))
+        self.dirty.update(map(chunk_of, cells))
+        return range(start, len(self.xs))
+
+    def set_block(self, index, block_name):
+        self.blocks[index] = self.palette_id(block_name)
+        self.dirty.add(chunk_of(cell_of(self.xs[index], self.ys[index])))
+
+    def move(self, index, x, y):
+        """Меняет координаты объекта и обновляет индекс сетки"""
+        old_cell = cell_of(self.xs[index], self.ys[index])
+        new_cell = cell_of(x, y)
+        self.xs[index] = int(x)
+        self.ys[index] = int(y)
+        self.dirty.add(chunk_of(old_cell))
+        self.dirty.add(chunk_of(new_cell))
+        if old_cell != new_cell:
+            if self.cells.get(old_cell) == index:
+                del self.cells[old_cell]
+            self.cells[new_cell] = index
+
+    def at(self, x, y):
+        """Номер объекта в клетке, содержащей точку, или None"""
+        return self.cells.get(cell_of(x, y))
+
+    def position(self, index):
+        return self.xs[index], self.ys[index]
+
+    def block_name(self, index):
+        return self.palette[self.blocks[index]]
+
+    def counts(self):
+        """Количество объектов каждого блока: имя -> число"""
+        per_id = [0] * len(self.palette)
+        for block_id in self.blocks:
+            per_id[block_id] += 1
+        return {name: count for name, count in zip(self.palette, per_id) if count}
+
+    def extend(self, level, block_names=None):
+        """Добавляет все блоки уровня массивами; block_names ограничивает допустимые имена.
+
+        Блоки в уже занятых клетках пропускаются, как при заливке и вставке
+        штампа, чтобы каждая клетка индексировала ровно один объект.
+        """
+        remap = [self.palette_id(name) if block_names is None or name in block_names else None
+                 for name in level.palette]
+        start = len(self.xs)
+        cells = [cell_of(x, y) for x, y in zip(level.xs, level.ys)]
+        free = len(set(cells)) == len(cells) and self.cells.keys().isdisjoint(cells)
+        if None in remap or not free:
+            for x, y, block, cell in zip(level.xs, level.ys, level.blocks, cells):
+                if remap[block] is not None and cell not in self.cells:
+                    self.add(x, y, level.palette[block])
+        else:
+            self.xs.extend(level.xs)
+            self.ys.extend(level.ys)
+            self.blocks.extend(array('H', [remap[block] for block in level.blocks]))
+            self.canvas_ids.extend(array('i', bytes(4 * len(level))))
+            self.cells.update(zip(cells, range(start, len(self.xs))))
+            self.dirty.update(map(chunk_of, cells))
+        return range(start, len(self.xs))
+
+    def chunk_level(self, chunk, background=None):
+        """Объекты одного чанка как отдельный Level (для автосохранения)"""
+        cx, cy = chunk
+        objects = []
+        for row in range(cy * AUTOSAVE_CHUNK, (cy + 1) * AUTOSAVE_CHUNK):
+            for col in range(cx * AUTOSAVE_CHUNK, (cx + 1) * AUTOSAVE_CHUNK):
+                index = self.cells.get((col, row))
+                if index is not None:
+                    objects.append({"x": self.xs[index], "y": self.ys[index], "block": self.block_name(index)})
+        return level_format.Level.from_objects(objects, background)
+
+    def to_level(self, background=None):
+        """Снимок для сохранения: копии массивов без обхода объектов"""
+        return level_format.Level(background, list(self.palette), array('i', self.xs), array('i', self.ys),
+                                  array('H', self.blocks), array('B', [1]) * len(self.xs))
+
+
+class EditJournal:
+    """Журнал правок для отмены и повтора.
+
+    Шаг — список операций над клетками, а не снимок карты:
+    ('add' | 'remove', x, y, имя блока), ('move', x0, y0, x1, y1),
+    ('fill', xs, ys, имя) и ('set', xs, ys, старое имя, новое имя) для
+    массовых правок и ('clear', Level, путь фона, PhotoImage фона, чанки TMX). Всё, что записано между begin() и end(), отменяется
+    одним шагом (например, всё перетаскивание целиком).
+    """
+
+    def __init__(self, limit=HISTORY_LIMIT):
+        self.limit = limit
+        self.undo_stack = []
+        self.redo_stack = []
+        self.group = None
+        self.depth = 0
+
+    def clear(self):
+        self.undo_stack = []
+        self.redo_stack = []
+        self.group = None
+        self.depth = 0
+
+    def begin(self):
+        self.depth += 1
+        if self.group is None:
+            self.group = []
+
+    def end(self):
+        if self.depth == 0:
+            return
+        self.depth -= 1
+        if self.depth == 0:
+            group, self.group = self.group, None
+            if group:
+                self.push(group)
+
+    def record(self, op):
+        if self.group is None:
+            self.push([op])
+            return
+        last = self.group[-1] if self.group else None
+        # Последовательные сдвиги одного объекта сливаются в один
+        if op[0] == 'move' and last and last[0] == 'move' and last[3:5] == op[1:3]:
+            self.group[-1] = ('move', last[1], last[2], op[3], op[4])
+        else:
+            self.group.append(op)
+
+    def push(self, group):
+        self.undo_stack.append(group)
+        del self.undo_stack[:-self.limit]
+        self.redo_stack = []
+
+    def pop_undo(self):
+        if self.undo_stack:
+            group = self.undo_stack.pop()
+            self.redo_stack.append(group)
+            return group
+        return None
+
+    def pop_redo(self):
+        if self.redo_stack:
+            group = self.redo_stack.pop()
+            self.undo_stack.append(group)
+            return group
+        return None
+
+
 class LevelEditor:
     def __init__(self, root):
         self.root = root
@@ -37,6 +629,7 @@ class LevelEditor:
         self.root.geometry(f"{CANVAS_WIDTH+20}x{CANVAS_HEIGHT+150}")
 
         # Create the canvas with a larger virtual size for panning
+        # (область прокрутки растёт вместе с картой, см. extend_scrollregion)
         self.canvas_width = CANVAS_WIDTH * 2  # Double the size for panning
         self.canvas_height = CANVAS_HEIGHT * 2
         self.view_x = 0
@@ -61,9 +654,9 @@ class LevelEditor:
             scrollregion=(0, 0, self.canvas_width, self.canvas_height)
         )
         
-        # Configure scrollbars
-        self.h_scrollbar.config(command=self.canvas.xview)
-        self.v_scrollbar.config(command=self.canvas.yview)
+        # Configure scrollbars (через обёртки, чтобы догружать видимые элементы)
+        self.h_scrollbar.config(command=self.scroll_x)
+        self.v_scrollbar.config(command=self.scroll_y)
         
         # Grid layout
         self.canvas.grid(row=0, column=0, sticky="nsew")
@@ -97,6 +690,11 @@ class LevelEditor:
         self.recent_blocks = []
         self.max_recent_blocks = 5
 
+        # Инструменты ПКМ: блок, прямоугольник, заливка, штамп
+        self.tool = tk.StringVar(value='block')
+        self.area_start = None        # угол выделяемого прямоугольника
+        self.stamp = []               # скопированный штамп: [(dx, dy, имя блока)]
+
         # Buttons frame
         button_frame = tk.Frame(self.frame)
         button_frame.pack(fill=tk.X, pady=5)
@@ -111,35 +709,86 @@ class LevelEditor:
         # Level operations
         tk.Button(button_frame, text="Открыть", command=self.load_level, width=8).pack(side=tk.LEFT, padx=2)
         tk.Button(button_frame, text="Сохранить", command=self.save_level, width=8).pack(side=tk.LEFT, padx=2)
+        tk.Button(button_frame, text="Очистить", command=self.clear_level, width=8).pack(side=tk.LEFT, padx=2)
+        tk.Button(button_frame, text="Автосейв", command=lambda: self.load_level(AUTOSAVE_FOLDER),
+                  width=8).pack(side=tk.LEFT, padx=2)
+        tk.Button(button_frame, text="Пред. сеанс", command=lambda: self.load_level(AUTOSAVE_PREV_FOLDER),
+                  width=10).pack(side=tk.LEFT, padx=2)
+        
+        ttk.Separator(button_frame, orient='vertical').pack(side=tk.LEFT, fill='y', padx=5)
+        
+        # Выбор инструмента для ПКМ
+        for value, text in (('block', "Блок"), ('rect', "Прямоуг."), ('flood', "Заливка"), ('stamp', "Штамп")):
+            tk.Radiobutton(button_frame, text=text, variable=self.tool, value=value,
+                           indicatoron=False, width=8).pack(side=tk.LEFT, padx=1)
         
         # Recent blocks dropdown
         self.recent_btn = tk.Menubutton(button_frame, text="Недавние ▼", width=12)
         self.recent_btn.pack(side=tk.LEFT, padx=2)
         self.recent_menu = tk.Menu(self.recent_btn, tearoff=0)
         self.recent_btn.config(menu=self.recent_menu)
+        
+        # Прогресс фоновой загрузки (виден только во время загрузки)
+        self.progress_frame = tk.Frame(button_frame)
+        self.progress_label = tk.Label(self.progress_frame, text="")
+        self.progress_label.pack(side=tk.LEFT, padx=2)
+        self.progress = ttk.Progressbar(self.progress_frame, length=200, mode='determinate')
+        self.progress.pack(side=tk.LEFT, padx=2)
+        tk.Button(self.progress_frame, text="Отмена", command=self.cancel_jobs, width=8).pack(side=tk.LEFT, padx=2)
+        
+        # Изображения декодируются в пуле потоков, результаты забирает цикл Tk
+        self.executor = ThreadPoolExecutor(max_workers=LOADER_THREADS)
+        self.results = queue.Queue()
+        self.jobs = []
+        self.level_loading = False    # идёт загрузка уровня (см. edits_blocked)
+        self.root.after(LOADER_POLL_MS, self._poll_jobs)
+        
+        # Автосохранение пишет только изменённые чанки, в том же пуле потоков
+        self.autosave_future = None
+        self.autosave_chunks = set()  # чанки последней записи (вернутся в dirty, если она не удалась)
+        self.autosave_full = True     # первая запись заменяет всё старое автосохранение
+        self.autosave_prune = True    # полная запись удаляет чанки, которых нет на карте
+        try:
+            rotate_autosave(AUTOSAVE_FOLDER, AUTOSAVE_PREV_FOLDER)
+        except OSError as e:
+            # Без переноса чанки прошлого сеанса не удаляются: запись только дополняет папку
+            print(f"⚠️ Не удалось перенести автосохранение прошлого сеанса: {str(e)}")
+            self.autosave_prune = False
+        self.root.after(AUTOSAVE_MS, self.autosave)
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
 
-        self.blocks = {}              # имя блока -> {path, img, tk_img}
+        self.blocks = {}              # ссылка на ресурс (asset_store) -> {name, path, img, tk_img}
         self.current_block = None
         self.bg_image = None
         self.bg_path = None
-        self.objects = []             # список всех объектов на карте
+        self.objects = ObjectStore()  # все объекты на карте
+        self.journal = EditJournal()   # история правок для Ctrl+Z / Ctrl+Y
         self.image_references = []    # список для хранения ссылок на PhotoImage
+        
+        # Виртуализация холста: элементы есть только у объектов рядом с видимой областью
+        self.visible_objects = set()  # номера объектов, у которых есть элемент на холсте
+        self.item_pool = []           # скрытые элементы холста для повторного использования
+        self.tmx_chunks = []          # [x, y, ширина, высота, функция сборки, PhotoImage, id]
+        self.tmx_images = OrderedDict()  # функция сборки -> собранный PhotoImage, в порядке LRU
+        self.tmx_pending = set()      # функции сборки, отправленные в пул потоков
 
         self.drag_data = {
-            "item": None,
-            "index": None,
-            "start_x": 0,
-            "start_y": 0
+            "item": None,       # номер перетаскиваемого объекта
+            "offset_x": 0,      # смещение центра объекта от курсора
+            "offset_y": 0
         }
         
         # Track selected block
         self.selected_block = None
 
-        self.canvas.bind("<Button-3>", self.place_or_delete_block)  # ПКМ — создать или удалить
+        self.canvas.bind("<Button-3>", self.tool_press)             # ПКМ — текущий инструмент
+        self.canvas.bind("<B3-Motion>", self.tool_drag)             # ПКМ движение — выделение области
+        self.canvas.bind("<ButtonRelease-3>", self.tool_release)
         self.canvas.bind("<Button-2>", self.copy_block)             # СКМ — копировать блок
-        self.canvas.bind("<Button-1>", self.pan_canvas)             # ЛКМ — панорамирование
-        self.canvas.bind("<B1-Motion>", self.pan_canvas)            # ЛКМ движение — панорамирование
-        self.canvas.bind("<ButtonRelease-1>", lambda e: None)       # Пустой обработчик для отпускания ЛКМ
+        self.canvas.bind("<Button-1>", self.start_drag)             # ЛКМ — перетаскивание блока или панорамирование
+        self.canvas.bind("<B1-Motion>", self.on_motion)             # ЛКМ движение — не чаще раза за кадр
+        self.canvas.bind("<ButtonRelease-1>", self.end_drag)
+        self.canvas.bind("<Configure>", lambda e: self.refresh_viewport())  # окно изменило размер
         
         # Bind arrow keys for navigation
         self.root.bind("<Left>", lambda e: self.pan_view(-50, 0))
@@ -147,14 +796,120 @@ class LevelEditor:
         self.root.bind("<Up>", lambda e: self.pan_view(0, -50))
         self.root.bind("<Down>", lambda e: self.pan_view(0, 50))
         
+        # Отмена и повтор
+        self.root.bind("<Control-z>", lambda e: self.undo())
+        self.root.bind("<Control-y>", lambda e: self.redo())
+        self.root.bind("<Control-Shift-Z>", lambda e: self.redo())
+        
         # Initialize panning state
         self.pan_start_x = 0
         self.pan_start_y = 0
         self.is_panning = False
         
+        # Объединение событий движения: обрабатывается только последнее
+        self.pending_motion = None
+        self.motion_job = None
+        self.last_motion = 0.0
+        
 
         os.makedirs(SAVE_FOLDER, exist_ok=True)
 
+    def start_job(self, title, tasks, on_result=None, on_done=None, on_error=None):
+        """Запускает задачи [(ключ, функция)] в пуле потоков.
+
+        Функции выполняют только работу PIL; колбэки вызываются в потоке Tk.
+        """
+        job = LoadJob(title, len(tasks), on_result, on_done, on_error)
+        self.jobs.append(job)
+        for key, func in tasks:
+            future = self.executor.submit(func)
+            future.add_done_callback(lambda f, k=key: self.results.put((job, k, f)))
+            job.futures.append(future)
+        if not tasks:
+            self._finish_job(job)
+        self._update_progress()
+        return job
+
+    def cancel_jobs(self):
+        """Отменяет все фоновые загрузки"""
+        for job in self.jobs:
+            job.cancelled = True
+            for future in job.futures:
+                future.cancel()
+            print(f"[X] Отменено: {job.title}")
+        self.jobs = []
+        self.tmx_pending.clear()
+        self.level_loading = False
+        self._update_progress()
+
+    def edits_blocked(self):
+        """Пока уровень загружается, правки запрещены: его объекты добавятся в конце загрузки"""
+        if self.level_loading:
+            print("⏳ Дождитесь окончания загрузки уровня")
+            return True
+        return False
+
+    def close(self):
+        self.cancel_jobs()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.root.destroy()
+
+    def _finish_job(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if job.on_done:
+            try:
+                job.on_done(job)
+            except Exception as e:
+                self._job_error(job, None, e)
+
+    def _job_error(self, job, key, error):
+        """Сообщает об ошибке задачи или её колбэка, не останавливая остальные загрузки"""
+        if job.on_error:
+            try:
+                job.on_error(key, error)
+                return
+            except Exception as e:
+                error = e
+        print(f"❌ {job.title}: {str(error)}")
+
+    def _poll_jobs(self):
+        """Передаёт готовые результаты из рабочих потоков в Tk"""
+        try:
+            while True:
+                try:
+                    job, key, future = self.results.get_nowait()
+                except queue.Empty:
+                    break
+                if job.cancelled or future.cancelled():
+                    continue
+                # Ошибка в колбэке относится к своей задаче и не рвёт цикл опроса
+                try:
+                    error = future.exception()
+                    if error is not None:
+                        raise error
+                    if job.on_result:
+                        job.on_result(key, future.result())
+                except Exception as e:
+                    self._job_error(job, key, e)
+                job.done += 1
+                if job.done == job.total:
+                    self._finish_job(job)
+            self._update_progress()
+        finally:
+            self.root.after(LOADER_POLL_MS, self._poll_jobs)
+
+    def _update_progress(self):
+        if not self.jobs:
+            self.progress_frame.pack_forget()
+            return
+        total = sum(job.total for job in self.jobs)
+        done = sum(job.done for job in self.jobs)
+        self.progress_label.config(text=self.jobs[0].title)
+        self.progress.config(maximum=max(total, 1), value=done)
+        if not self.progress_frame.winfo_ismapped():
+            self.progress_frame.pack(side=tk.LEFT, padx=10)
+
     def load_background(self):
         path = filedialog.askopenfilename(filetypes=[
             ("Image Files", "*.png;*.jpg;*.jpeg"),
@@ -166,109 +921,52 @@ class LevelEditor:
         if path.lower().endswith('.tmx'):
             self.load_tmx_file(path)
             return
-        if path:
-            self.bg_path = path
-            # Load and tile the background image
-            try:
-                original_img = Image.open(path)
-                img_width, img_height = original_img.size
-                
-                # Create a new image large enough to hold 40 tiles (5x8 grid)
-                tiled_img = Image.new('RGBA', (img_width * 8, img_height * 5))
-                
-                # Tile the image
-                for x in range(0, img_width * 8, img_width):
-                    for y in range(0, img_height * 5, img_height):
-                        tiled_img.paste(original_img, (x, y))
-                
-                # Resize to fit canvas while maintaining aspect ratio
-                tiled_img = tiled_img.resize((CANVAS_WIDTH, CANVAS_HEIGHT), Image.Resampling.LANCZOS)
-                
-                self.bg_image = ImageTk.PhotoImage(tiled_img)
-                self.canvas.create_image(0, 0, anchor=tk.NW, image=self.bg_image)
-                
-            except Exception as e:
-                messagebox.showerror("Ошибка", f"Не удалось загрузить изображение: {str(e)}")
+        self.apply_background(path)
+
+    def apply_background(self, path):
+        """Загружает фон в фоновом потоке и показывает его по готовности"""
+        def on_error(key, e):
+            messagebox.showerror("Ошибка", f"Не удалось загрузить изображение: {str(e)}")
+        self.start_job("Фон", [(path, partial(build_background, path))],
+                       on_result=self.set_background_image, on_error=on_error)
+
+    def set_background_image(self, path, tiled_img):
+        self.show_background(path, ImageTk.PhotoImage(tiled_img))
+
+    def show_background(self, path, bg_image):
+        """Ставит готовый PhotoImage фоном холста"""
+        self.bg_path = path
+        self.bg_image = bg_image
+        self.canvas.delete('background')
+        self.canvas.create_image(0, 0, anchor=tk.NW, image=self.bg_image, tags='background')
+        self.canvas.tag_lower('background')
     
     def load_tmx_file(self, tmx_path):
         """Загружает карту из файла .tmx"""
-        try:
-            # Парсим XML файл
-            tree = ET.parse(tmx_path)
-            root = tree.getroot()
-            
-            # Получаем размеры карты
-            map_width = int(root.get('width'))
-            map_height = int(root.get('height'))
-            tile_width = int(root.get('tilewidth'))
-            tile_height = int(root.get('tileheight'))
+        def on_result(key, chunks):
+            # Очищаем холст
+            self.canvas.delete("all")
+            self.image_references = []
+            self.visible_objects.clear()
+            self.item_pool = []
+            self.objects.canvas_ids = array('i', bytes(4 * len(self.objects)))
             
-            # Ищем слой с данными тайлов
-            for layer in root.findall('layer'):
-                data = layer.find('data')
-                if data is not None and data.get('encoding') == 'csv':
-                    # Очищаем холст
-                    self.canvas.delete("all")
-                    
-                    # Получаем данные тайлов
-                    tile_data = []
-                    for row in data.text.strip().split('\n'):
-                        row_data = [int(tile) for tile in row.split(',') if tile.strip()]
-                        if row_data:
-                            tile_data.append(row_data)
-                    
-                    # Загружаем тайлсет
-                    for tileset in root.findall('tileset'):
-                        firstgid = int(tileset.get('firstgid'))
-                        source = tileset.get('source')
-                        
-                        # Если тайлсет встроен в файл
-                        image = tileset.find('image')
-                        if image is not None:
-                            image_path = os.path.join(os.path.dirname(tmx_path), image.get('source'))
-                            try:
-                                tileset_img = Image.open(image_path)
-                                tileset_img = tileset_img.convert('RGBA')
-                                
-                                # Отображаем тайлы на холсте
-                                for y, row in enumerate(tile_data):
-                                    for x, tile_id in enumerate(row):
-                                        if tile_id != 0:  # 0 означает пустой тайл
-                                            # Вычисляем позицию тайла в тайлсете
-                                            tile_id -= firstgid
-                                            if tile_id >= 0:  # Проверяем, что tile_id валидный
-                                                cols = tileset_img.width // tile_width
-                                                tile_x = (tile_id % cols) * tile_width
-                                                tile_y = (tile_id // cols) * tile_height
-                                                
-                                                # Вырезаем тайл из тайлсета
-                                                tile = tileset_img.crop((tile_x, tile_y, 
-                                                                      tile_x + tile_width, 
-                                                                      tile_y + tile_height))
-                                                
-                                                # Преобразуем в формат Tkinter
-                                                tile_tk = ImageTk.PhotoImage(tile)
-                                                self.image_references.append(tile_tk)  # Сохраняем ссылку
-                                                
-                                                # Отображаем тайл на холсте
-                                                self.canvas.create_image(
-                                                    x * tile_width, 
-                                                    y * tile_height, 
-                                                    image=tile_tk, 
-                                                    anchor=tk.NW
-                                                )
-                                
-                            except Exception as e:
-                                messagebox.showerror("Ошибка", f"Не удалось загрузить тайлсет: {str(e)}")
-                                return
-                    
-                    messagebox.showinfo("Успех", f"Карта успешно загружена: {os.path.basename(tmx_path)}")
-                    return
+            # Чанки слоёв попадают на холст, только когда оказываются в видимой области
+            self.tmx_chunks = [[x, y, width, height, compose, None, 0]
+                               for x, y, width, height, compose in chunks]
+            self.tmx_images.clear()
+            self.tmx_pending.clear()
+            self.extend_scrollregion(max((x + width for x, _, width, _, _ in chunks), default=0),
+                                     max((y + height for _, y, _, height, _ in chunks), default=0))
+            self.refresh_viewport()
             
-            messagebox.showwarning("Предупреждение", "Не удалось найти данные тайлов в файле")
-            
-        except Exception as e:
+            messagebox.showinfo("Успех", f"Карта успешно загружена: {os.path.basename(tmx_path)}")
+        
+        def on_error(key, e):
             messagebox.showerror("Ошибка", f"Не удалось загрузить файл .tmx: {str(e)}")
+        
+        self.start_job("Карта .tmx", [(tmx_path, partial(decode_tmx, tmx_path))],
+                       on_result=on_result, on_error=on_error)
 
     def add_to_recent_blocks(self, block_name):
         """Добавляет блок в список недавних"""
@@ -297,7 +995,8 @@ class LevelEditor:
             
         for block_name in self.recent_blocks:
             # Add block name with ellipsis if too long
-            display_name = block_name if len(block_name) < 20 else f"{block_name[:17]}..."
+            label = self.block_label(block_name)
+            display_name = label if len(label) < 20 else f"{label[:17]}..."
             self.recent_menu.add_command(
                 label=display_name,
                 command=lambda b=block_name: self.select_recent_block(b)
@@ -307,7 +1006,7 @@ class LevelEditor:
         """Выбирает блок из списка недавних"""
         if block_name in self.blocks:
             self.current_block = block_name
-            print(f"[i] Выбран блок: {block_name}")
+            print(f"[i] Выбран блок: {self.block_label(block_name)}")
             return True
         return False
 
@@ -321,42 +1020,54 @@ class LevelEditor:
             print("❌ Файл не выбран или не существует")
             return None
             
-        block_name = os.path.basename(filepath)
+        def on_result(path, result):
+            ref, img = result
+            self.register_block(ref, path, img)
+            self.current_block = ref
         
-        # Check if block already exists
-        if block_name in self.blocks:
-            print(f"[i] Блок '{block_name}' уже загружен")
-            self.current_block = block_name
-            return self.blocks[block_name]["img"]
-            
-        try:
-            # Open and resize the image
-            img = Image.open(filepath)
-            img = img.resize((BLOCK_SIZE, BLOCK_SIZE), Image.Resampling.LANCZOS)
-            
-            # Convert to PhotoImage and store
-            tk_img = ImageTk.PhotoImage(img)
-            
-            # Store the image and path
-            self.blocks[block_name] = {
-                "path": filepath,
-                "img": tk_img,
-                "tk_img": tk_img  # Keep a reference
-            }
-            
-            self.current_block = block_name
-            print(f"[+] Загружен блок: {block_name}")
-            
-            # Add to recent blocks
-            self.add_to_recent_blocks(block_name)
-            
-            return tk_img
-            
-        except Exception as e:
+        def on_error(path, e):
             error_msg = f"❌ Ошибка загрузки блока: {str(e)}"
             print(error_msg)
             messagebox.showerror("Ошибка", error_msg)
-            return None
+        
+        # Hash, open and resize the image in a worker thread
+        self.start_job("Блок", [(filepath, partial(decode_block, filepath))],
+                       on_result=on_result, on_error=on_error)
+        return None
+
+    def register_block(self, ref, filepath, img, name=None):
+        """Создаёт PhotoImage для готового изображения блока (только в потоке Tk).
+
+        Блоки различаются по содержимому: одинаковые файлы под разными именами
+        дают один блок, разные файлы с одним именем — разные. name — имя для
+        показа, по умолчанию имя файла.
+        """
+        block_name = name or os.path.basename(filepath)
+        if ref in self.blocks:
+            print(f"[i] Блок '{block_name}' уже загружен")
+            self.add_to_recent_blocks(ref)
+            return self.blocks[ref]["img"]
+        
+        # Convert to PhotoImage and store
+        tk_img = ImageTk.PhotoImage(img)
+        
+        # Store the image and path
+        self.blocks[ref] = {
+            "name": block_name,
+            "path": filepath,
+            "img": tk_img,
+            "tk_img": tk_img  # Keep a reference
+        }
+        print(f"[+] Загружен блок: {block_name}")
+        
+        # Add to recent blocks
+        self.add_to_recent_blocks(ref)
+        return tk_img
+
+    def block_label(self, ref):
+        """Имя файла блока для показа пользователю"""
+        block = self.blocks.get(ref)
+        return block["name"] if block else ref
 
     def copy_block(self, event):
         """Копирует блок по нажатию средней кнопки мыши"""
@@ -367,39 +1078,161 @@ class LevelEditor:
         # Find the object at the clicked position
         index = self.find_object_at(x, y)
         if index is not None:
-            obj = self.objects[index]
-            block_name = obj["block"]
+            block_name = self.objects.block_name(index)
             if block_name in self.blocks:
                 # Select the block for copying
                 self.current_block = block_name
-                print(f"[i] Выбран для копирования: {block_name}")
+                print(f"[i] Выбран для копирования: {self.block_label(block_name)}")
                 # Add to recent blocks
                 self.add_to_recent_blocks(block_name)
                 # Place a new block at cursor position
                 self.place_or_delete_block(event)
     
+    def remove_object(self, index):
+        """Удаляет объект из хранилища, поправляя выделение и перетаскивание"""
+        if self.selected_block == index:
+            self.selected_block = None
+            self.canvas.delete('selection_rect')
+        if self.drag_data.get("item") == index:
+            self.drag_data["item"] = None
+        self.release_item(index)
+        last = len(self.objects) - 1
+        removed = self.objects.remove(index)
+        # Последний объект переехал на место удалённого
+        if index != last:
+            if self.selected_block == last:
+                self.selected_block = index
+            if self.drag_data.get("item") == last:
+                self.drag_data["item"] = index
+            if last in self.visible_objects:
+                self.visible_objects.discard(last)
+                self.visible_objects.add(index)
+        return removed
+
+    def visible_region(self):
+        """Видимая область холста с запасом: (лево, верх, право, низ)"""
+        left = self.canvas.canvasx(0)
+        top = self.canvas.canvasy(0)
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        if width <= 1 or height <= 1:  # окно ещё не отображено
+            width, height = CANVAS_WIDTH, CANVAS_HEIGHT
+        return (left - VIEW_MARGIN, top - VIEW_MARGIN,
+                left + width + VIEW_MARGIN, top + height + VIEW_MARGIN)
+
+    def acquire_item(self, index):
+        """Создаёт (или берёт из пула) элемент холста для объекта"""
+        if index in self.visible_objects:
+            return self.objects.canvas_ids[index]
+        x, y = self.objects.position(index)
+        image = self.blocks[self.objects.block_name(index)]["img"]
+        if self.item_pool:
+            item = self.item_pool.pop()
+            self.canvas.coords(item, x, y)
+            self.canvas.itemconfigure(item, image=image, state=tk.NORMAL)
+        else:
+            item = self.canvas.create_image(x, y, image=image, anchor=tk.CENTER, tags='block')
+        self.objects.canvas_ids[index] = item
+        self.visible_objects.add(index)
+        return item
+
+    def release_item(self, index):
+        """Прячет элемент холста объекта и возвращает его в пул"""
+        if index not in self.visible_objects:
+            return
+        item = self.objects.canvas_ids[index]
+        self.canvas.itemconfigure(item, state=tk.HIDDEN)
+        self.item_pool.append(item)
+        self.objects.canvas_ids[index] = 0
+        self.visible_objects.discard(index)
+
+    def extend_scrollregion(self, right, bottom):
+        """Расширяет область прокрутки так, чтобы за точкой (right, bottom) оставался ещё экран"""
+        width = max(self.canvas_width, int(right) + CANVAS_WIDTH)
+        height = max(self.canvas_height, int(bottom) + CANVAS_HEIGHT)
+        if width != self.canvas_width or height != self.canvas_height:
+            self.canvas_width = width
+            self.canvas_height = height
+            self.canvas.configure(scrollregion=(0, 0, width, height))
+
+    def refresh_viewport(self):
+        """Оставляет элементы холста только для объектов и чанков TMX рядом с видимой областью"""
+        left, top, right, bottom = self.visible_region()
+        
+        # Объекты ищем по индексу сетки только в видимых клетках
+        cells = self.objects.cells
+        wanted = set()
+        for row in range(int(top) // BLOCK_SIZE, int(bottom) // BLOCK_SIZE + 1):
+            for col in range(int(left) // BLOCK_SIZE, int(right) // BLOCK_SIZE + 1):
+                index = cells.get((col, row))
+                if index is not None:
+                    wanted.add(index)
+        # Перетаскиваемый объект не трогаем
+        if self.drag_data.get("item") is not None:
+            wanted.add(self.drag_data["item"])
+        
+        for index in self.visible_objects - wanted:
+            self.release_item(index)
+        for index in wanted - self.visible_objects:
+            self.acquire_item(index)
+        
+        # Чанки TMX: на холсте только видимые; изображения собираются в пуле потоков,
+        # а собранные остаются в LRU и после ухода из видимой области
+        created = False
+        tasks = []
+        for chunk in self.tmx_chunks:
+            x, y, width, height, compose, chunk_tk, item = chunk
+            inside = x < right and x + width > left and y < bottom and y + height > top
+            if inside and not item:
+                chunk_tk = self.tmx_images.get(compose)
+                if chunk_tk is not None:
+                    self.tmx_images.move_to_end(compose)
+                    chunk[5] = chunk_tk
+                    chunk[6] = self.canvas.create_image(x, y, image=chunk_tk, anchor=tk.NW, tags='tmx')
+                    created = True
+                elif compose not in self.tmx_pending:
+                    self.tmx_pending.add(compose)
+                    tasks.append((compose, compose))
+            elif not inside and item:
+                self.canvas.delete(item)
+                chunk[5] = None
+                chunk[6] = 0
+        if tasks:
+            self.start_job("Чанки карты", tasks, on_result=self.add_tmx_image, on_error=self.tmx_image_failed)
+        if created:
+            # Восстанавливаем порядок слоёв: чанки создаются не в порядке отрисовки
+            for chunk in self.tmx_chunks:
+                if chunk[6]:
+                    self.canvas.tag_raise(chunk[6])
+            self.canvas.tag_lower('tmx')
+            self.canvas.tag_lower('background')
+
+    def add_tmx_image(self, compose, image):
+        """Кэширует собранный чанк TMX (в потоке Tk) и показывает его, если он виден"""
+        self.tmx_pending.discard(compose)
+        self.tmx_images[compose] = ImageTk.PhotoImage(image)
+        # Показанные чанки держат свой PhotoImage сами, вытеснение их не трогает
+        while len(self.tmx_images) > TMX_CHUNK_CACHE:
+            self.tmx_images.popitem(last=False)
+        self.refresh_viewport()
+
+    def tmx_image_failed(self, compose, e):
+        # Чанк запросится снова при следующем обновлении видимой области
+        self.tmx_pending.discard(compose)
+        print(f"❌ Не удалось собрать чанк карты: {str(e)}")
+
     def is_position_taken(self, x, y, ignore_index=None):
-        for i, obj in enumerate(self.objects):
-            if ignore_index is not None and i == ignore_index:
-                continue
-            if obj["x"] == x and obj["y"] == y:
-                return True
-        return False
+        index = self.objects.at(x, y)
+        return index is not None and index != ignore_index
 
     def find_object_at(self, x, y):
-        """Находит объект по координатам с учетом смещения просмотра"""
-        for i, obj in enumerate(self.objects):
-            obj_x, obj_y = obj["x"], obj["y"]
-            # Convert canvas coordinates to view coordinates
-            view_x = x - self.view_x
-            view_y = y - self.view_y
-            if (obj_x - BLOCK_SIZE//2 <= view_x <= obj_x + BLOCK_SIZE//2 and 
-                obj_y - BLOCK_SIZE//2 <= view_y <= obj_y + BLOCK_SIZE//2):
-                return i
-        return None
+        """Находит объект по координатам холста (объекты хранятся в них же)"""
+        return self.objects.at(x, y)
 
     def place_or_delete_block(self, event):
         """Создает или удаляет блок при нажатии ПКМ"""
+        if self.edits_blocked():
+            return
         if not self.current_block:
             print("⚠️ Сначала загрузите блок!")
             return
@@ -414,31 +1247,176 @@ class LevelEditor:
         index = self.find_object_at(grid_x, grid_y)
         if index is not None:
             # Если есть — удалим блок с canvas и из списка
-            obj = self.objects.pop(index)
-            self.canvas.delete(obj["canvas_id"])
-            print(f"[X] Блок удалён: {obj['block']} на ({obj['x']}, {obj['y']})")
+            x, y, block_name, canvas_id = self.remove_object(index)
+            self.journal.record(('remove', x, y, block_name))
+            print(f"[X] Блок удалён: {self.block_label(block_name)} на ({x}, {y})")
             print(f"[i] Осталось блоков на карте: {len(self.objects)}")
             return
 
         # Если блока нет — создаём новый (если выбран)
         if self.current_block not in self.blocks:
-            print(f"[X] Ошибка: блок '{self.current_block}' не найден в загруженных блоках")
+            print(f"[X] Ошибка: блок '{self.block_label(self.current_block)}' не найден в загруженных блоках")
             return
             
-        block_data = self.blocks[self.current_block]
-        obj_id = self.canvas.create_image(grid_x, grid_y, image=block_data["img"], anchor=tk.CENTER)
-        
-        self.objects.append({
-            "x": grid_x, 
-            "y": grid_y, 
-            "block": self.current_block, 
-            "canvas_id": obj_id,
-            "image_reference": block_data["img"]  # Keep reference to prevent garbage collection
-        })
-        
-        print(f"[+] Размещён блок '{self.current_block}' на позиции ({grid_x}, {grid_y})")
+        # Блок под курсором всегда виден — сразу создаём для него элемент холста
+        self.acquire_item(self.objects.add(grid_x, grid_y, self.current_block))
+        self.journal.record(('add', grid_x, grid_y, self.current_block))
+        self.extend_scrollregion(grid_x + BLOCK_SIZE // 2, grid_y + BLOCK_SIZE // 2)
+        
+        print(f"[+] Размещён блок '{self.block_label(self.current_block)}' на позиции ({grid_x}, {grid_y})")
         print(f"[i] Всего блоков на карте: {len(self.objects)}")
 
+    def event_cell(self, event):
+        """Центр клетки сетки под курсором с учетом смещения просмотра"""
+        x = event.x + self.view_x
+        y = event.y + self.view_y
+        return (int(x // BLOCK_SIZE) * BLOCK_SIZE + BLOCK_SIZE // 2,
+                int(y // BLOCK_SIZE) * BLOCK_SIZE + BLOCK_SIZE // 2)
+
+    def area_cells(self, x0, y0, x1, y1):
+        """Центры всех клеток прямоугольника между двумя клетками"""
+        x0, x1 = sorted((x0, x1))
+        y0, y1 = sorted((y0, y1))
+        return [(x, y) for y in range(y0, y1 + 1, BLOCK_SIZE) for x in range(x0, x1 + 1, BLOCK_SIZE)]
+
+    def tool_press(self, event):
+        """ПКМ: блок ставится сразу, прямоугольник и копирование штампа — протягиванием"""
+        if self.edits_blocked():
+            return
+        tool = self.tool.get()
+        if tool == 'block':
+            self.place_or_delete_block(event)
+        elif tool == 'flood':
+            self.flood_fill(*self.event_cell(event))
+        elif tool == 'stamp' and self.stamp and not event.state & 0x0001:
+            self.paste_stamp(*self.event_cell(event))
+        else:
+            # Прямоугольник или Shift+ПКМ в режиме штампа — копирование области
+            self.area_start = self.event_cell(event)
+            self.draw_area_preview(*self.area_start)
+
+    def tool_drag(self, event):
+        if self.area_start is not None:
+            self.draw_area_preview(*self.event_cell(event))
+
+    def tool_release(self, event):
+        if self.area_start is None:
+            return
+        x0, y0 = self.area_start
+        x1, y1 = self.event_cell(event)
+        self.area_start = None
+        self.canvas.delete('area_preview')
+        if self.tool.get() == 'rect':
+            self.fill_rect(x0, y0, x1, y1)
+        else:
+            self.copy_stamp(x0, y0, x1, y1)
+
+    def draw_area_preview(self, x, y):
+        x0, y0 = self.area_start
+        half = BLOCK_SIZE // 2
+        self.canvas.delete('area_preview')
+        self.canvas.create_rectangle(
+            min(x0, x) - half, min(y0, y) - half, max(x0, x) + half, max(y0, y) + half,
+            outline='yellow', width=2, dash=(4, 4), tags='area_preview'
+        )
+
+    def add_batch(self, positions, block_name):
+        """Размещает блоки пачкой: одно обновление индекса, элементы холста — позже"""
+        if positions:
+            self.objects.add_many(positions, block_name)
+            self.journal.record(('fill', array('i', [x for x, _ in positions]),
+                                 array('i', [y for _, y in positions]), block_name))
+            self.extend_scrollregion(max(x for x, _ in positions) + BLOCK_SIZE // 2,
+                                     max(y for _, y in positions) + BLOCK_SIZE // 2)
+
+    def fill_rect(self, x0, y0, x1, y1):
+        """Заполняет пустые клетки прямоугольника текущим блоком"""
+        if self.current_block not in self.blocks:
+            print("⚠️ Сначала загрузите блок!")
+            return
+        cells = self.objects.cells
+        positions = [(x, y) for x, y in self.area_cells(x0, y0, x1, y1) if cell_of(x, y) not in cells]
+        self.add_batch(positions, self.current_block)
+        self.refresh_viewport()
+        print(f"[+] Заполнено клеток: {len(positions)} ('{self.block_label(self.current_block)}'), всего блоков: {len(self.objects)}")
+
+    def flood_fill(self, x, y):
+        """Заливает связную область пустых клеток или клеток того же блока текущим блоком"""
+        if self.current_block not in self.blocks:
+            print("⚠️ Сначала загрузите блок!")
+            return
+        cells = self.objects.cells
+        start = self.objects.at(x, y)
+        target = None if start is None else self.objects.block_name(start)
+        if target == self.current_block:
+            return
+        
+        def matches(cell):
+            index = cells.get(cell)
+            if index is None:
+                return target is None
+            return target is not None and self.objects.block_name(index) == target
+        
+        cols = self.canvas_width // BLOCK_SIZE
+        rows = self.canvas_height // BLOCK_SIZE
+        first = cell_of(x, y)
+        seen = {first}
+        stack = [first]
+        region = []
+        while stack:
+            col, row = stack.pop()
+            region.append((col, row))
+            for cell in ((col + 1, row), (col - 1, row), (col, row + 1), (col, row - 1)):
+                if cell not in seen and 0 <= cell[0] < cols and 0 <= cell[1] < rows and matches(cell):
+                    seen.add(cell)
+                    stack.append(cell)
+        
+        positions = [(col * BLOCK_SIZE + BLOCK_SIZE // 2, row * BLOCK_SIZE + BLOCK_SIZE // 2)
+                     for col, row in region]
+        if target is None:
+            self.add_batch(positions, self.current_block)
+            self.refresh_viewport()
+        else:
+            self.set_blocks(positions, self.current_block)
+            self.journal.record(('set', array('i', [px for px, _ in positions]),
+                                 array('i', [py for _, py in positions]), target, self.current_block))
+        print(f"[+] Залито клеток: {len(positions)} ('{self.block_label(self.current_block)}'), всего блоков: {len(self.objects)}")
+
+    def set_blocks(self, positions, block_name):
+        """Меняет блок у объектов в клетках; на холсте обновляются только видимые"""
+        image = self.blocks[block_name]["img"]
+        for x, y in positions:
+            index = self.objects.at(x, y)
+            if index is not None:
+                self.objects.set_block(index, block_name)
+                if index in self.visible_objects:
+                    self.canvas.itemconfigure(self.objects.canvas_ids[index], image=image)
+
+    def copy_stamp(self, x0, y0, x1, y1):
+        """Копирует блоки прямоугольника в штамп"""
+        left, top = min(x0, x1), min(y0, y1)
+        self.stamp = []
+        for x, y in self.area_cells(x0, y0, x1, y1):
+            index = self.objects.at(x, y)
+            if index is not None:
+                self.stamp.append((x - left, y - top, self.objects.block_name(index)))
+        print(f"[i] В штамп скопировано блоков: {len(self.stamp)}")
+
+    def paste_stamp(self, x, y):
+        """Вставляет штамп левым верхним углом в клетку; занятые клетки пропускаются"""
+        cells = self.objects.cells
+        by_block = {}
+        for dx, dy, block_name in self.stamp:
+            if block_name in self.blocks and cell_of(x + dx, y + dy) not in cells:
+                by_block.setdefault(block_name, []).append((x + dx, y + dy))
+        # Вся вставка — один шаг отмены
+        self.journal.begin()
+        for block_name, positions in by_block.items():
+            self.add_batch(positions, block_name)
+        self.journal.end()
+        self.refresh_viewport()
+        print(f"[+] Вставлено блоков: {sum(map(len, by_block.values()))}, всего блоков: {len(self.objects)}")
+
     def pan_view(self, dx, dy):
         """Перемещает вид на указанное смещение"""
         # Calculate new view position
@@ -457,31 +1435,40 @@ class LevelEditor:
             # Update canvas view
             self.canvas.xview_moveto(self.view_x / self.canvas_width)
             self.canvas.yview_moveto(self.view_y / self.canvas_height)
-            
-            # Обновляем выделение при панорамировании
-            if self.selected_block is not None and self.selected_block < len(self.objects):
-                self.select_block(self.selected_block)
+            # Рамка выделения — элемент холста и прокручивается вместе с ним
+            self.refresh_viewport()
     
 
+    def scroll_x(self, *args):
+        """Горизонтальная полоса прокрутки"""
+        self.canvas.xview(*args)
+        self.view_x = self.canvas.canvasx(0)
+        self.refresh_viewport()
+    
+    def scroll_y(self, *args):
+        """Вертикальная полоса прокрутки"""
+        self.canvas.yview(*args)
+        self.view_y = self.canvas.canvasy(0)
+        self.refresh_viewport()
+
     def _on_mousewheel(self, event):
         """Обработка колесика мыши для вертикальной прокрутки"""
         self.canvas.yview_scroll(int(-1 * (event.delta / 120)), "units")
         self.view_y = self.canvas.canvasy(0)
-        self.draw_arrow_indicators()
+        self.refresh_viewport()
     
     def _on_shift_mousewheel(self, event):
         """Обработка Shift+колесико для горизонтальной прокрутки"""
         self.canvas.xview_scroll(int(-1 * (event.delta / 120)), "units")
         self.view_x = self.canvas.canvasx(0)
-        self.draw_arrow_indicators()
+        self.refresh_viewport()
     
     def select_block(self, index):
         """Выделяет блок"""
         self.selected_block = index
         if index is not None:
             # Рисуем рамку выделения
-            obj = self.objects[index]
-            x, y = obj['x'], obj['y']
+            x, y = self.objects.position(index)
             self.canvas.delete('selection_rect')
             self.canvas.create_rectangle(
                 x - 25, y - 25, x + 25, y + 25,
@@ -491,16 +1478,16 @@ class LevelEditor:
     def move_block(self, index, new_x, new_y):
         """Перемещает блок на новые координаты"""
         if 0 <= index < len(self.objects):
-            obj = self.objects[index]
-            
             # Проверяем, не занята ли новая позиция
             if not self.is_position_taken(new_x, new_y, index):
                 # Обновляем координаты
-                obj['x'] = new_x
-                obj['y'] = new_y
+                old_x, old_y = self.objects.position(index)
+                self.objects.move(index, new_x, new_y)
+                self.journal.record(('move', old_x, old_y, new_x, new_y))
                 
                 # Перемещаем на холсте
-                self.canvas.coords(obj['canvas_id'], new_x - self.view_x, new_y - self.view_y)
+                if index in self.visible_objects:
+                    self.canvas.coords(self.objects.canvas_ids[index], new_x, new_y)
                 
                 # Обновляем выделение
                 if self.selected_block == index:
@@ -509,16 +1496,20 @@ class LevelEditor:
     def start_drag(self, event):
         """Начинает перетаскивание блока или панорамирование"""
         # Проверяем, кликнули ли мы по блоку
-        index = self.find_object_at(event.x + self.view_x, event.y + self.view_y)
-        if index is not None:
+        x = event.x + self.view_x
+        y = event.y + self.view_y
+        index = self.find_object_at(x, y)
+        if index is not None and not self.edits_blocked():
             # Выделяем блок
             self.select_block(index)
             
-            # Начинаем перетаскивание
+            # Начинаем перетаскивание; всё перетаскивание — один шаг отмены
+            self.journal.begin()
+            block_x, block_y = self.objects.position(index)
             self.drag_data = {
                 "item": index,
-                "x": event.x + self.view_x,
-                "y": event.y + self.view_y
+                "offset_x": block_x - x,
+                "offset_y": block_y - y
             }
         else:
             # Убираем выделение
@@ -531,6 +1522,30 @@ class LevelEditor:
             self.is_panning = True
             self.canvas.config(cursor="fleur")
     
+    def on_motion(self, event):
+        """Запоминает последнее событие движения и планирует одну обработку на кадр"""
+        self.pending_motion = event
+        if self.motion_job is None:
+            wait = int(self.last_motion + MOTION_FRAME_MS - time.perf_counter() * 1000)
+            if wait > 0:
+                self.motion_job = self.root.after(wait, self.flush_motion)
+            else:
+                self.motion_job = self.root.after_idle(self.flush_motion)
+    
+    def flush_motion(self):
+        """Применяет накопившееся движение: одно панорамирование или один сдвиг блока"""
+        if self.motion_job is not None:
+            self.root.after_cancel(self.motion_job)
+            self.motion_job = None
+        event, self.pending_motion = self.pending_motion, None
+        if event is None:
+            return
+        self.last_motion = time.perf_counter() * 1000
+        if self.is_panning:
+            self.pan_canvas(event)
+        elif self.drag_data.get("item") is not None:
+            self.do_drag(event)
+    
     def pan_canvas(self, event):
         """Обрабатывает панорамирование холста"""
         if self.is_panning:
@@ -544,61 +1559,146 @@ class LevelEditor:
             # Update start position for next movement
             self.pan_start_x = event.x
             self.pan_start_y = event.y
-            
-            # Обновляем выделение при панорамировании
-            if self.selected_block is not None and self.selected_block < len(self.objects):
-                self.select_block(self.selected_block)
     
     def do_drag(self, event):
-        """Перетаскивает блок"""
-        if "item" in self.drag_data:
-            index = self.drag_data["item"]
-            dx = event.x + self.view_x - self.drag_data["x"]
-            dy = event.y + self.view_y - self.drag_data["y"]
-            
-            # Move the block
-            self.canvas.move(self.objects[index]["canvas_id"], dx, dy)
-            
-            # Update position
-            self.drag_data["x"] = event.x + self.view_x
-            self.drag_data["y"] = event.y + self.view_y
-            
-            # Update object position
-            self.objects[index]["x"] += dx
-            self.objects[index]["y"] += dy
+        """Перетаскивает блок, сразу привязывая его к сетке"""
+        index = self.drag_data.get("item")
+        if index is None:
+            return
+        new_x, new_y = snap_to_grid(event.x + self.view_x + self.drag_data["offset_x"],
+                                    event.y + self.view_y + self.drag_data["offset_y"],
+                                    self.canvas_width, self.canvas_height)
+        # Блок двигается только в свободную клетку и только когда клетка сменилась
+        if (new_x, new_y) != self.objects.position(index):
+            self.move_block(index, new_x, new_y)
     
     def end_drag(self, event):
         """Завершает перетаскивание блока или панорамирование"""
+        # Последнее движение применяется до завершения
+        self.on_motion(event)
+        self.flush_motion()
         if self.is_panning:
             self.is_panning = False
             self.canvas.config(cursor="")
-        elif "item" in self.drag_data:
-            # Update the final position
-            index = self.drag_data["item"]
-            coords = self.canvas.coords(self.objects[index]["canvas_id"])
-            if coords:  # Check if the item still exists
-                self.objects[index]["x"] = coords[0]
-                self.objects[index]["y"] = coords[1]
-        self.drag_data = {}
+        else:
+            # Группа журнала закрывается, даже если блок удалили во время перетаскивания
+            self.journal.end()
+        self.drag_data = {"item": None, "offset_x": 0, "offset_y": 0}
 
     def clear_level(self):
-        """Очищает текущий уровень"""
-        # Clear all objects from canvas
-        for obj in self.objects:
-            self.canvas.delete(obj["canvas_id"])
-        self.objects = []
+        """Очищает текущий уровень (всё можно вернуть через Ctrl+Z)"""
+        # Очистка во время загрузки отменяет её, иначе объекты уровня появятся после
+        if self.level_loading:
+            self.cancel_jobs()
+        # Массивы объектов уходят в журнал как есть, без обхода по одному, фон и
+        # чанки TMX — готовыми PhotoImage и функциями сборки
+        if len(self.objects) or self.bg_image is not None or self.tmx_chunks:
+            self.journal.record(('clear', self.objects.to_level(), self.bg_path, self.bg_image, self.tmx_chunks))
+        
+        # Clear all objects (холст очищается целиком ниже)
+        self.objects.clear()
+        self.visible_objects.clear()
+        self.item_pool = []
+        self.tmx_chunks = []
+        self.selected_block = None
         self.bg_image = None
         self.bg_path = None
         self.canvas.delete("all")
         print("ℹ️ Уровень очищен")
     
+    def undo(self):
+        """Отменяет последний шаг журнала"""
+        if self.edits_blocked():
+            return
+        group = self.journal.pop_undo()
+        if group is None:
+            print("[i] Нечего отменять")
+            return
+        for op in reversed(group):
+            self.apply_op(op, undo=True)
+        self.refresh_viewport()
+        print(f"[<] Отменено операций: {len(group)}")
+
+    def redo(self):
+        """Повторяет отменённый шаг журнала"""
+        if self.edits_blocked():
+            return
+        group = self.journal.pop_redo()
+        if group is None:
+            print("[i] Нечего повторять")
+            return
+        for op in group:
+            self.apply_op(op)
+        self.refresh_viewport()
+        print(f"[>] Повторено операций: {len(group)}")
+
+    def apply_op(self, op, undo=False):
+        """Применяет операцию журнала (или обратную ей) к хранилищу и холсту.
+
+        Элементы холста для добавленных объектов создаёт refresh_viewport.
+        """
+        kind = op[0]
+        if kind == 'move':
+            _, x0, y0, x1, y1 = op
+            if undo:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            index = self.objects.at(x0, y0)
+            if index is not None:
+                self.objects.move(index, x1, y1)
+                if index in self.visible_objects:
+                    self.canvas.coords(self.objects.canvas_ids[index], x1, y1)
+                if self.selected_block == index:
+                    self.select_block(index)
+        elif kind == 'fill':
+            _, xs, ys, block_name = op
+            if undo:
+                for x, y in zip(xs, ys):
+                    index = self.objects.at(x, y)
+                    if index is not None:
+                        self.remove_object(index)
+            elif block_name in self.blocks:
+                self.objects.add_many(list(zip(xs, ys)), block_name)
+        elif kind == 'set':
+            _, xs, ys, old_name, new_name = op
+            block_name = old_name if undo else new_name
+            if block_name in self.blocks:
+                self.set_blocks(list(zip(xs, ys)), block_name)
+        elif kind == 'clear':
+            _, level, bg_path, bg_image, tmx_chunks = op
+            self.canvas.delete('tmx')
+            if undo:
+                self.objects.extend(level, self.blocks)
+                if bg_image is not None:
+                    self.show_background(bg_path, bg_image)
+                # Элементы холста чанков создаст refresh_viewport
+                self.tmx_chunks = [[x, y, width, height, compose, None, 0]
+                                   for x, y, width, height, compose, _, _ in tmx_chunks]
+            else:
+                for index in list(self.visible_objects):
+                    self.release_item(index)
+                self.selected_block = None
+                self.canvas.delete('selection_rect')
+                self.objects.clear()
+                self.canvas.delete('background')
+                self.bg_path = None
+                self.bg_image = None
+                self.tmx_chunks = []
+        else:
+            _, x, y, block_name = op
+            if (kind == 'add') == undo:
+                index = self.objects.at(x, y)
+                if index is not None:
+                    self.remove_object(index)
+            elif block_name in self.blocks:
+                self.objects.add(x, y, block_name)
+
     def load_level(self, filepath=None):
         """Загружает уровень из файла"""
         if not filepath:
             filepath = filedialog.askopenfilename(
                 initialdir=os.path.abspath(SAVE_FOLDER),
                 title="Выберите файл уровня",
-                filetypes=[("Файлы уровня", "*.py"), ("Все файлы", "*.*")]
+                filetypes=[("Файлы уровня", "*.klvl;*.json;*.py"), ("Все файлы", "*.*")]
             )
         
         if not filepath or not os.path.exists(filepath):
@@ -606,66 +1706,70 @@ class LevelEditor:
             return False
             
         try:
-            # Clear current level
-            self.clear_level()
-            
-            # Load the level file
-            level_dir = os.path.dirname(filepath)
-            level_globals = {}
-            with open(filepath, 'r', encoding='utf-8') as f:
-                exec(f.read(), level_globals)
-            
-            # Set background if exists
-            if 'background_image' in level_globals and level_globals['background_image']:
-                bg_path = os.path.join(level_dir, level_globals['background_image'])
-                if os.path.exists(bg_path):
-                    self.bg_path = bg_path
-                    self.load_background()
-            
-            # Load blocks
-            if 'objects' in level_globals:
-                for obj in level_globals['objects']:
-                    block_name = obj['block']
-                    x, y = obj['x'], obj['y']
-                    
-                    # Load block if not already loaded
-                    if block_name not in self.blocks:
-                        block_path = os.path.join(level_dir, block_name)
-                        if os.path.exists(block_path):
-                            self.load_block(block_path)
-                    
-                    # Create block on canvas
-                    if block_name in self.blocks:
-                        block_data = self.blocks[block_name]
-                        obj_id = self.canvas.create_image(x, y, image=block_data["img"], anchor=tk.CENTER)
-                        
-                        self.objects.append({
-                            "x": x,
-                            "y": y,
-                            "block": block_name,
-                            "canvas_id": obj_id,
-                            "image_reference": block_data["img"]
-                        })
-                        
-                        # Add to recent blocks
-                        self.add_to_recent_blocks(block_name)
+            # Load the level file (старые .py файлы читаются без выполнения кода,
+            # папка автосохранения собирается из чанков)
+            level_dir = filepath if os.path.isdir(filepath) else os.path.dirname(filepath)
+            level = level_format.load_level(filepath)
+        except Exception as e:
+            # Текущая карта и журнал правок не тронуты
+            error_msg = f"❌ Ошибка при загрузке уровня: {str(e)}"
+            print(error_msg)
+            messagebox.showerror("Ошибка", error_msg)
+            return False
+        
+        # Clear current level только после того, как файл прочитан
+        self.cancel_jobs()
+        self.clear_level()
+        self.journal.clear()
+        
+        # Изображения блоков и фон декодируются в пуле потоков, каждый блок один раз.
+        # Ссылки на ресурсы ищутся рядом с уровнем и в общем хранилище
+        tasks = []
+        for block_name in level.palette:
+            block_path = asset_store.locate(block_name, level_dir, SAVE_FOLDER)
+            if block_name not in self.blocks and block_path:
+                tasks.append((block_name, partial(decode_block, block_path)))
+        bg_path = asset_store.locate(level.background, level_dir, SAVE_FOLDER) if level.background else None
+        if bg_path:
+            tasks.append((None, partial(build_background, bg_path)))
+        
+        refs = {}  # имя в файле уровня -> ссылка на ресурс (старые уровни хранят имена файлов)
+        
+        def on_result(block_name, result):
+            if block_name is None:
+                self.set_background_image(bg_path, result)
+            else:
+                ref, img = result
+                # Файлы в хранилище названы по хэшу, исходное имя хранится рядом
+                self.register_block(ref, asset_store.locate(block_name, level_dir, SAVE_FOLDER), img,
+                                    asset_store.display_name(block_name, level_dir, SAVE_FOLDER))
+                refs[block_name] = ref
+        
+        def on_done(job):
+            self.level_loading = False
+            # Add all blocks with known images in bulk; canvas items only for the visible ones
+            level.palette = [refs.get(name, name) for name in level.palette]
+            self.objects.extend(level, self.blocks)
+            if len(self.objects):
+                self.extend_scrollregion(max(self.objects.xs) + BLOCK_SIZE // 2,
+                                         max(self.objects.ys) + BLOCK_SIZE // 2)
+            self.refresh_viewport()
             
             print(f"✅ Уровень загружен: {os.path.basename(filepath)}")
             print(f"ℹ️ Загружено объектов: {len(self.objects)}")
             
             # Update window title
             self.root.title(f"Редактор Уровня - {os.path.basename(filepath)}")
-            
-            return True
-            
-        except Exception as e:
-            error_msg = f"❌ Ошибка при загрузке уровня: {str(e)}"
-            print(error_msg)
-            messagebox.showerror("Ошибка", error_msg)
-            return False
+        
+        # До on_done карта пуста, а правки запрещены (edits_blocked)
+        self.level_loading = True
+        self.start_job("Загрузка уровня", tasks, on_result=on_result, on_done=on_done)
+        return True
     
     def save_level(self):
         """Сохраняет текущий уровень"""
+        if self.edits_blocked():
+            return
         # Ensure save directory exists
         os.makedirs(SAVE_FOLDER, exist_ok=True)
         
@@ -674,28 +1778,75 @@ class LevelEditor:
         if not level_name:
             return
             
-        if not level_name.endswith('.py'):
-            level_name += '.py'
+        # Бинарный формат по умолчанию, .json — отладочный вариант
+        if not level_name.endswith(('.klvl', '.json')):
+            level_name += level_format.EXTENSION
             
-        level_py_path = os.path.join(SAVE_FOLDER, level_name)
-        bg_name = os.path.basename(self.bg_path) if self.bg_path else None
+        level_path = os.path.join(SAVE_FOLDER, level_name)
 
-        with open(level_py_path, "w", encoding="utf-8") as f:
-            f.write(f'background_image = {repr(bg_name)}\n\n')
-            f.write('objects = [\n')
-            for obj in self.objects:
-                f.write(f'    {{"x": {obj["x"]}, "y": {obj["y"]}, "block": {repr(obj["block"])}, "solid": True}},\n')
-            f.write(']\n')
+        # Используемые ресурсы попадают в общее хранилище по хэшу (уже лежащие там
+        # не копируются) раньше файла уровня, который на них ссылается
+        # Блоки — под ссылкой, вычисленной при их загрузке: на неё указывает уровень
+        counts = self.objects.counts()
+        bg_ref = asset_store.ref_for(self.bg_path) if self.bg_path else None
+        assets = {ref: self.blocks[ref]["path"] for ref in counts if ref in self.blocks}
+        if bg_ref:
+            assets[bg_ref] = self.bg_path
+        new_assets = [ref for ref in assets if not os.path.exists(os.path.join(SAVE_FOLDER, ref))]
+        renamed = {}  # старая ссылка -> ссылка на изменившийся после загрузки файл
+        for ref, path in assets.items():
+            try:
+                asset_store.import_asset(path, SAVE_FOLDER, ref)
+            except ValueError:
+                renamed[ref] = asset_store.import_asset(path, SAVE_FOLDER)
+                print(f"⚠️ Файл '{self.block_label(ref)}' изменился после загрузки, "
+                      f"в уровень записана его новая версия")
 
-        if self.bg_path:
-            copyfile(self.bg_path, os.path.join(SAVE_FOLDER, bg_name))
+        # Файл уровня пишется во временный и атомарно переименовывается
+        level = self.objects.to_level(bg_ref)
+        level.palette = [renamed.get(ref, ref) for ref in level.palette]
+        level.background = renamed.get(bg_ref, bg_ref)
+        level_format.save_level(level_path, level)
 
-        for block_name, block_data in self.blocks.items():
-            copyfile(block_data["path"], os.path.join(SAVE_FOLDER, block_name))
+        print(f"\n✅ Уровень сохранён в файл: {level_path}")
+        print(f"ℹ️ Сохранено объектов: {len(level)}, новых ресурсов: {len(new_assets)} из {len(assets)}")
+        for ref, count in counts.items():
+            print(f"    {self.block_label(ref)}: {count}")
+        print()
 
-        print(f"\n✅ Уровень сохранён в файл: {level_py_path}\n")
-        with open(level_py_path, "r", encoding="utf-8") as f:
-            print(f.read())
+    def autosave(self):
+        """Фоновое автосохранение в AUTOSAVE_FOLDER: на диск уходят только изменённые чанки"""
+        self.root.after(AUTOSAVE_MS, self.autosave)
+        future = self.autosave_future
+        if future is not None:
+            if not future.done():
+                return
+            if future.exception() is not None:
+                # Неудавшиеся чанки снова грязные, и запись сразу повторяется целиком
+                print(f"❌ Ошибка автосохранения: {str(future.exception())}")
+                self.objects.dirty.update(self.autosave_chunks)
+                self.autosave_full = True
+            self.autosave_future = None
+        # Недозагруженный уровень пуст: его чанки запишутся после загрузки
+        if not self.objects.dirty or self.level_loading:
+            return
+        
+        chunks = set(self.objects.dirty)
+        if self.autosave_full:
+            chunks.update(chunk_of(cell) for cell in self.objects.cells)
+        self.objects.dirty.clear()
+        
+        # Снимки чанков делаются здесь, в потоке Tk; в рабочий поток уходит только запись
+        bg_ref = asset_store.ref_for(self.bg_path) if self.bg_path else None
+        snapshots = {chunk: self.objects.chunk_level(chunk, bg_ref) for chunk in chunks}
+        assets = {(self.blocks[ref]["path"], ref)
+                  for level in snapshots.values() for ref in level.palette if ref in self.blocks}
+        if self.bg_path:
+            assets.add((self.bg_path, bg_ref))
+        self.autosave_chunks = chunks
+        self.autosave_future = self.executor.submit(
+            write_autosave, AUTOSAVE_FOLDER, snapshots, assets, self.autosave_full and self.autosave_prune)
+        self.autosave_full = False
 
 
 if __name__ == "__main__":
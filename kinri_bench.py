@@ -0,0 +1,128 @@
+"""Headless frame-time benchmark for KINRI.
+
+Drives draw_level, the ruby animation and Player.update for a number of
+frames on synthetic maps of increasing size and prints per-stage frame time
+percentiles. Runs without a display through SDL's dummy video driver.
+
+    python kinri_bench.py --frames 300 --sizes 80x15,320x60,1280x120
+"""
+import os
+import sys
+import json
+import random
+import argparse
+import time
+
+os.environ["KINRI_HEADLESS"] = "1"
+
+import pygame
+import kinri_level1 as level
+import kinri_main as game
+
+# Both modules open a display; draw into whichever surface is current
+level.screen = pygame.display.get_surface()
+level.SCREEN_WIDTH, level.SCREEN_HEIGHT = level.screen.get_size()
+
+
+def synthetic_map(width, height, seed=0):
+    """Builds a level_map-style list of rows with platforms, boxes, spikes and rubies."""
+    rng = random.Random(seed)
+    rows = [[" "] * width for _ in range(height)]
+    for x in range(width):
+        rows[height - 1][x] = "#"
+    for _ in range(width * height // 40):
+        x = rng.randrange(width - 8)
+        y = rng.randrange(2, height - 1)
+        for dx in range(rng.randint(3, 8)):
+            rows[y][x + dx] = "#"
+        above = rows[y - 1]
+        choice = rng.random()
+        if choice < 0.3:
+            above[x], above[x + 1] = "[", "]"
+        elif choice < 0.5:
+            above[x + 2] = "^"
+        elif choice < 0.9:
+            above[x + 1] = "$"
+    return ["".join(row) for row in rows]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def bench_map(width, height, frames):
+    """Runs every stage for `frames` frames and returns {stage: [ms, ...]}."""
+    rows = synthetic_map(width, height)
+    world = level.ChunkedWorld.from_rows(rows)
+    tile_layer = level.StaticTileLayer(world)
+    positions = level.find_ruby_positions(world)
+    rubies = level.RubyField(positions)
+    animated = [level.AnimatedRuby(x, y) for x, y in positions]
+    player = game.Player("Main Characters\\q\\Run.png", 100, 100, 192, 192, 0, 0)
+    barriers = game.TileGrid(rows)
+
+    timings = {"draw_level": [], "ruby_field": [], "animated_ruby": [], "player_update": []}
+    max_scroll = max(0, width * level.TILE_SIZE - level.SCREEN_WIDTH)
+    for frame in range(frames):
+        # Scroll across the map so chunks keep streaming in
+        level.camera.camera.x = -((frame * 16) % (max_scroll + 1))
+        level.camera.camera.y = 0
+        camera = level.camera.camera
+        world.stream(pygame.Rect(-camera.x, -camera.y, level.SCREEN_WIDTH, level.SCREEN_HEIGHT))
+
+        start = time.perf_counter()
+        level.draw_level(tile_layer, rubies)
+        timings["draw_level"].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        rubies.update(level.SIM_STEP)
+        timings["ruby_field"].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        for ruby in animated:
+            ruby.update(level.SIM_STEP)
+            ruby.draw(level.screen, camera.x, camera.y)
+        timings["animated_ruby"].append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        player.update(barriers)
+        timings["player_update"].append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--sizes", default="80x15,320x60,1280x120",
+                        help="comma separated WIDTHxHEIGHT map sizes in tiles")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    print(f"{'map':>10} {'stage':>14} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for size in args.sizes.split(","):
+        width, height = (int(v) for v in size.lower().split("x"))
+        for stage, values in bench_map(width, height, args.frames).items():
+            row = {
+                "map": size,
+                "stage": stage,
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "max": max(values),
+            }
+            results.append(row)
+            print(f"{size:>10} {stage:>14} {row['p50']:8.3f} {row['p95']:8.3f} {row['p99']:8.3f} {row['max']:8.3f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"frames": args.frames, "results": results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,8 +2,17 @@ import pygame
 import os
 import sys
 import math
+import json
+import csv
+import time
+from array import array
+from collections import OrderedDict
 from typing import List, Tuple, Optional
 
+import level_format
+from levels import (level_map, HEADLESS, SIM_STEP, MAX_FRAME_TIME, MAX_STEPS_PER_FRAME,
+                    MAX_FPS)
+
 # Initialize Pygame
 pygame.init()
 
@@ -23,6 +32,173 @@ class Camera:
 # Create camera
 camera = Camera(SCREEN_WIDTH, SCREEN_HEIGHT)
 
+class FrameProfiler:
+    """Per-frame stage timings and blit/allocation counters.
+
+    lap(stage) charges the time since the previous lap to that stage. The
+    last frame can be drawn as an overlay (F3) and all frames can be written
+    to a CSV or JSON trace with export().
+    """
+
+    STAGES = ("events", "update_camera", "animate", "stream", "background", "tiles",
+              "rubies", "hud", "flip", "tick")
+    COUNTERS = ("blits", "surfaces")
+
+    def __init__(self):
+        self.show_overlay = False
+        self.recording = False
+        self.frames = []  # recorded frames, each {stage/counter: value}
+        self.last = {}
+        self.current = {}
+        self._mark = time.perf_counter()
+
+    def begin_frame(self):
+        self.current = dict.fromkeys(self.STAGES + self.COUNTERS, 0)
+        self._mark = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.current[stage] = self.current.get(stage, 0) + (now - self._mark) * 1000
+        self._mark = now
+
+    def count(self, counter: str, n: int = 1):
+        self.current[counter] = self.current.get(counter, 0) + n
+
+    def end_frame(self):
+        self.last = self.current
+        if self.recording:
+            self.frames.append(self.current)
+
+    def draw(self, surface: pygame.Surface):
+        # Rendered straight from the font: the numbers change every frame, and
+        # going through text_cache would count the overlay's own surfaces and
+        # push the HUD strings out of the cache
+        lines = [f"{stage:>14}: {self.last.get(stage, 0):6.2f} ms" for stage in self.STAGES]
+        lines += [f"{counter:>14}: {self.last.get(counter, 0)}" for counter in self.COUNTERS]
+        font = get_font(None, 22)
+        y = 50
+        for line in lines:
+            surface.blit(font.render(line, True, (255, 255, 0)), (10, y))
+            y += 18
+
+    def export(self, path: str):
+        """Writes the recorded frames as CSV or, for *.json paths, JSON."""
+        columns = ("frame",) + self.STAGES + self.COUNTERS
+        rows = [dict(frame=i, **frame) for i, frame in enumerate(self.frames)]
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if path.lower().endswith(".json"):
+                json.dump({"columns": columns, "frames": rows}, f)
+            else:
+                writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+                writer.writeheader()
+                writer.writerows(rows)
+
+# Create profiler
+profiler = FrameProfiler()
+
+# HUD settings
+TEXT_CACHE_SIZE = 256  # rendered strings kept around
+WHITE = (255, 255, 255)
+
+_fonts = {}
+
+def get_font(name: Optional[str], size: int) -> pygame.font.Font:
+    """Returns a shared Font, constructing it only on first use."""
+    font = _fonts.get((name, size))
+    if font is None:
+        font = _fonts[(name, size)] = pygame.font.Font(name, size)
+    return font
+
+class TextCache:
+    """Rendered text surfaces keyed by (text, font, colour), LRU-evicted."""
+
+    def __init__(self, max_entries: int = TEXT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def render(self, text: str, font: Tuple[Optional[str], int] = (None, 36),
+               colour: Tuple[int, int, int] = WHITE) -> pygame.Surface:
+        key = (text, font, colour)
+        rendered = self.entries.get(key)
+        if rendered is not None:
+            self.entries.move_to_end(key)
+            return rendered
+
+        rendered = get_font(*font).render(text, True, colour)
+        profiler.count("surfaces")
+        self.entries[key] = rendered
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return rendered
+
+text_cache = TextCache()
+
+class HudLabel:
+    """A HUD text element that only re-renders when its value changes."""
+
+    def __init__(self, template: str, pos: Tuple[int, int],
+                 font: Tuple[Optional[str], int] = (None, 36), colour: Tuple[int, int, int] = WHITE):
+        self.template = template
+        self.pos = pos
+        self.font = font
+        self.colour = colour
+        self.value = None
+        self.surface = None
+        self.rect = None  # screen area of the current text
+
+    def set(self, value) -> bool:
+        """Updates the value; returns True if the label had to be re-rendered."""
+        if self.surface is not None and value == self.value:
+            return False
+        self.value = value
+        self.surface = text_cache.render(self.template.format(value), self.font, self.colour)
+        self.rect = self.surface.get_rect(topleft=self.pos)
+        return True
+
+    def draw(self, surface: pygame.Surface, value) -> pygame.Rect:
+        self.set(value)
+        profiler.count("blits")
+        return surface.blit(self.surface, self.pos)
+
+# Dirty-rect settings
+MAX_DIRTY_RECTS = 32  # above this, dirty regions are merged into one
+
+class DirtyRenderer:
+    """Collects the screen regions that changed and presents only those.
+
+    A full redraw (invalidate()) is presented with display.flip(); otherwise
+    only the marked rects are repainted, clipped, and pushed with
+    display.update(rects).
+    """
+
+    def __init__(self):
+        self.rects = []
+        self.full = True
+
+    def invalidate(self):
+        self.full = True
+
+    def mark(self, rect: Optional[pygame.Rect]):
+        if rect is not None and rect.width > 0 and rect.height > 0:
+            self.rects.append(pygame.Rect(rect))
+
+    def redraw(self, surface: pygame.Surface, draw):
+        """Repaints the marked regions by calling draw() with a clip set."""
+        if len(self.rects) > MAX_DIRTY_RECTS:
+            self.rects = [self.rects[0].unionall(self.rects[1:])]
+        for rect in self.rects:
+            surface.set_clip(rect)
+            draw()
+        surface.set_clip(None)
+
+    def present(self):
+        if self.full:
+            pygame.display.flip()
+        elif self.rects:
+            pygame.display.update(self.rects)
+        self.rects = []
+        self.full = False
+
 # Load images
 try:
     # First try with the original path structure
@@ -32,131 +208,432 @@ except FileNotFoundError:
     # If the above fails, try with the full path
     import os
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    tileset = pygame.image.load(os.path.join(base_dir, "Levels", "Tiled", "Tileset.png")).convert_alpha()
-    background = pygame.image.load(os.path.join(base_dir, "Levels", "Preview", "lvl.jpg")).convert()
+    try:
+        tileset = pygame.image.load(os.path.join(base_dir, "Levels", "Tiled", "Tileset.png")).convert_alpha()
+        background = pygame.image.load(os.path.join(base_dir, "Levels", "Preview", "lvl.jpg")).convert()
+    except FileNotFoundError:
+        if not HEADLESS:
+            raise
+        # Without the art, headless runs get flat-coloured tiles and background
+        tileset = pygame.Surface((4 * 64, 2 * 64), pygame.SRCALPHA).convert_alpha()
+        for i, colour in enumerate([(120, 80, 40), (200, 40, 60), (220, 20, 60), (160, 160, 170)]):
+            tileset.fill(colour, (i * 64, 0, 64, 64))
+            tileset.fill(colour, (i * 64, 64, 64, 64))
+        background = pygame.Surface((1920, 1080)).convert()
+        background.fill((40, 60, 90))
+
+class BackgroundCache:
+    """Keeps scaled copies of the background keyed by window size.
+
+    Scaling the full-resolution image is the most expensive step of a frame,
+    so it is only redone when the window is resized. The background always
+    covers the window, so zooming does not change it.
+    The least recently used entries are dropped once max_entries is reached.
+    """
+
+    def __init__(self, image: pygame.Surface, max_entries: int = 4):
+        self.image = image
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, size: Tuple[int, int]) -> pygame.Surface:
+        key = tuple(size)
+        scaled = self.entries.get(key)
+        if scaled is not None:
+            self.entries.move_to_end(key)
+            return scaled
+
+        # Scale to cover the whole window
+        bg_width, bg_height = self.image.get_size()
+        scale = max(size[0] / bg_width, size[1] / bg_height)
+        scaled = pygame.transform.scale(self.image,
+            (int(bg_width * scale), int(bg_height * scale))).convert()
+        profiler.count("surfaces")
+
+        self.entries[key] = scaled
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return scaled
+
+background_cache = BackgroundCache(background)
 
 # Tile settings
 TILE_SIZE = 64  # all blocks are 64x64 pixels
 
 # Animation settings
 ANIMATION_SPEED = 0.05  # Speed of the pulsing animation
+PULSE_STEPS = 64  # Number of pre-rendered phases in one pulse cycle
+
+class PulseAtlas:
+    """Pre-scaled frames for one cycle of the ruby pulse.
+
+    The sin pulse only produces 14 distinct sizes (51-64 px for a 64 px tile),
+    so each size is scaled once and every phase step points at the matching frame.
+    """
+
+    def __init__(self, base_tile: pygame.Surface, steps: int = PULSE_STEPS):
+        self.steps = steps
+        self.frames = []  # phase step -> (surface, offset inside the tile)
+        self.sizes = []  # phase step -> frame size, equal sizes mean equal images
+        scaled_by_size = {}
+        for i in range(steps):
+            # Calculate scale factor (0.8 to 1.0)
+            scale = 0.9 + 0.1 * math.sin(2 * math.pi * i / steps)
+            size = int(TILE_SIZE * scale)
+            if size not in scaled_by_size:
+                scaled_by_size[size] = pygame.transform.scale(base_tile, (size, size))
+            # Offset keeps the ruby centered
+            self.frames.append((scaled_by_size[size], (TILE_SIZE - size) // 2))
+            self.sizes.append(size)
+
+    def step(self, animation_time: float) -> int:
+        return int(animation_time * self.steps / (2 * math.pi)) % self.steps
+
+_ruby_atlas: Optional[PulseAtlas] = None
+
+def get_ruby_atlas() -> PulseAtlas:
+    """Returns the pulse atlas shared by all rubies, building it on first use."""
+    global _ruby_atlas
+    if _ruby_atlas is None:
+        _ruby_atlas = PulseAtlas(tileset.subsurface((2 * TILE_SIZE, 0, TILE_SIZE, TILE_SIZE)))
+    return _ruby_atlas
 
 class AnimatedRuby:
     def __init__(self, x: int, y: int):
         self.x = x
         self.y = y
         self.animation_time = 0
-        self.base_tile = tileset.subsurface((2 * TILE_SIZE, 0, TILE_SIZE, TILE_SIZE))
+        self.atlas = get_ruby_atlas()
         
     def update(self, dt: float):
         # Update animation time
         self.animation_time += dt * ANIMATION_SPEED
         self.animation_time %= (2 * math.pi)  # Keep it in 0-2π range for smooth looping
         
-    def draw(self, surface: pygame.Surface):
-        # Calculate scale factor (0.8 to 1.0)
-        scale = 0.9 + 0.1 * math.sin(self.animation_time)
-        
-        # Create a scaled copy of the ruby
-        new_size = (int(TILE_SIZE * scale), int(TILE_SIZE * scale))
-        if new_size[0] > 0 and new_size[1] > 0:
-            scaled_ruby = pygame.transform.scale(self.base_tile, new_size)
-            
-            # Calculate position to keep the ruby centered
-            x_offset = (TILE_SIZE - new_size[0]) // 2
-            y_offset = (TILE_SIZE - new_size[1]) // 2
-            
-            # Draw the scaled ruby
-            surface.blit(scaled_ruby, 
-                        (self.x * TILE_SIZE + x_offset, 
-                         self.y * TILE_SIZE + y_offset))
+    def draw(self, surface: pygame.Surface, offset_x: int = 0, offset_y: int = 0):
+        frame, offset = self.atlas.frames[self.atlas.step(self.animation_time)]
+        surface.blit(frame, 
+                    (self.x * TILE_SIZE + offset + offset_x, 
+                     self.y * TILE_SIZE + offset + offset_y))
+
+class RubyField:
+    """All rubies of a level stored as flat arrays.
+
+    update() advances every phase and resolves its atlas frame in a single
+    pass, draw() only blits the pre-scaled frames of visible rubies.
+    """
+
+    def __init__(self, positions: List[Tuple[int, int]]):
+        self.atlas = get_ruby_atlas()
+        self.xs = array("i", (x for x, _ in positions))
+        self.ys = array("i", (y for _, y in positions))
+        self.phases = array("d", bytes(8 * len(positions)))
+        self.steps = array("H", bytes(2 * len(positions)))
+        # Frame size each ruby was last presented with (0 = never drawn)
+        self.drawn_sizes = array("H", bytes(2 * len(positions)))
+
+    def __len__(self):
+        return len(self.xs)
+
+    def changed_rects(self, surface: pygame.Surface, offset_x: int, offset_y: int) -> List[pygame.Rect]:
+        """Screen rects of visible rubies whose frame changed since they were last drawn."""
+        view_w, view_h = surface.get_size()
+        sizes = self.atlas.sizes
+        drawn_sizes = self.drawn_sizes
+        rects = []
+        for i, step in enumerate(self.steps):
+            size = sizes[step]
+            if size == drawn_sizes[i]:
+                continue
+            drawn_sizes[i] = size
+            screen_x = self.xs[i] * TILE_SIZE + offset_x
+            screen_y = self.ys[i] * TILE_SIZE + offset_y
+            if -TILE_SIZE <= screen_x <= view_w and -TILE_SIZE <= screen_y <= view_h:
+                rects.append(pygame.Rect(screen_x, screen_y, TILE_SIZE, TILE_SIZE))
+        return rects
+
+    def mark_drawn(self):
+        """Records the current frames as presented after a full redraw."""
+        sizes = self.atlas.sizes
+        self.drawn_sizes = array("H", (sizes[step] for step in self.steps))
+
+    def update(self, dt: float):
+        delta = dt * ANIMATION_SPEED
+        two_pi = 2 * math.pi
+        to_step = self.atlas.steps / two_pi
+        n_steps = self.atlas.steps
+        phases = self.phases
+        steps = self.steps
+        for i in range(len(phases)):
+            phase = (phases[i] + delta) % two_pi
+            phases[i] = phase
+            steps[i] = int(phase * to_step) % n_steps
+
+    def draw(self, surface: pygame.Surface, offset_x: int, offset_y: int):
+        view_w, view_h = surface.get_size()
+        frames = self.atlas.frames
+        blits = 0
+        for x, y, step in zip(self.xs, self.ys, self.steps):
+            screen_x = x * TILE_SIZE + offset_x
+            screen_y = y * TILE_SIZE + offset_y
+            # Only draw if visible
+            if -TILE_SIZE <= screen_x <= view_w and -TILE_SIZE <= screen_y <= view_h:
+                frame, offset = frames[step]
+                surface.blit(frame, (screen_x + offset, screen_y + offset))
+                blits += 1
+        profiler.count("blits", blits)
 
 # Function to get a tile from the tileset
 def get_tile(x: int, y: int) -> pygame.Surface:
     return tileset.subsurface((x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE))
 
-# Level map (manually created)
-level_map = [
-    "                                                                                ",
-    "                                                                                ",
-    "                            $$$                                                 ",
-    "      [ ]                  #####                  [ ]                           ",
-    "     ####                ##     ##               ####                           ",
-    "    ##                  ##       ##             ##                              ",
-    "   ##                  ##         ##           ##                               ",
-    "  ##                  ##           ##         ##                                ",
-    " ##                  ##             ##       ##                                 ",
-    "##                  ##               ##     ##                                  ",
-    "                    ##               ##     ##                                  ",
-    "                    ##               ##     ##                                  ",
-    "                    #################       #################                   ",
-    "                                                                                ",
-    "                                                                                "
-]
-
-# Symbols:
-# '#' - ground
-# '[' - box start
-# ']' - box end
-# '$' - ruby
-# '^' - spikes
-
-def draw_level(rubies: List[AnimatedRuby], dt: float):
-    # Draw background (scaled to fit screen)
-    bg_width, bg_height = background.get_size()
-    scale = max(SCREEN_WIDTH / bg_width, SCREEN_HEIGHT / bg_height)
-    scaled_bg = pygame.transform.scale(background, 
-        (int(bg_width * scale), int(bg_height * scale)))
-    screen.blit(scaled_bg, (0, 0))
-    
-    # Calculate visible area
-    start_x = max(0, -camera.camera.x // TILE_SIZE - 1)
-    end_x = min(len(level_map[0]), (-camera.camera.x + SCREEN_WIDTH) // TILE_SIZE + 2)
-    start_y = max(0, -camera.camera.y // TILE_SIZE - 1)
-    end_y = min(len(level_map), (-camera.camera.y + SCREEN_HEIGHT) // TILE_SIZE + 2)
+# Static tile layer settings
+CHUNK_TILES = 16  # chunks are CHUNK_TILES x CHUNK_TILES tiles
+MAX_LOADED_CHUNKS = 256  # memory budget of a ChunkedWorld, in chunks
+STREAM_MARGIN = 1  # chunks kept loaded around the visible area
+TILE_SURFACE_BUDGET = 64 * 1024 * 1024  # bytes of pre-rendered chunk surfaces kept
+
+class ChunkedWorld:
+    """Tile map split into CHUNK_TILES x CHUNK_TILES chunks loaded on demand.
+
+    Chunks live in a flat array indexed by chunk_y * cols + chunk_x, so a tile
+    lookup is two divisions and two indexings. Only chunks near the camera are
+    kept in memory; the least recently used ones are evicted once more than
+    max_chunks are loaded.
+
+    On disk a world is a directory with a world.json header and one text file
+    per chunk (chunk_<x>_<y>.txt, CHUNK_TILES lines of CHUNK_TILES symbols).
+    """
+
+    def __init__(self, width: int, height: int, load_chunk, entities=None,
+                 chunk_tiles: int = CHUNK_TILES, max_chunks: int = MAX_LOADED_CHUNKS):
+        self.width = width
+        self.height = height
+        self.load_chunk = load_chunk  # (chunk_x, chunk_y) -> list of row strings
+        self.entities = entities or {}  # symbol -> [(x, y), ...]
+        self.chunk_tiles = chunk_tiles
+        self.max_chunks = max_chunks
+        self.cols = -(-width // chunk_tiles)
+        self.rows = -(-height // chunk_tiles)
+        self.chunks = [None] * (self.cols * self.rows)
+        self.loaded = OrderedDict()  # chunk index -> None, in LRU order
+        self.evict_listeners = []  # called with (chunk_x, chunk_y)
+
+    @classmethod
+    def from_rows(cls, rows: List[str], **kwargs) -> "ChunkedWorld":
+        """Wraps an in-memory map such as level_map."""
+        chunk_tiles = kwargs.get("chunk_tiles", CHUNK_TILES)
+        width = max((len(row) for row in rows), default=0)
+        padded = [row.ljust(width) for row in rows]
+
+        def load_chunk(chunk_x, chunk_y):
+            x0 = chunk_x * chunk_tiles
+            y0 = chunk_y * chunk_tiles
+            return [row[x0:x0 + chunk_tiles].ljust(chunk_tiles)
+                    for row in padded[y0:y0 + chunk_tiles]]
+
+        entities = {"$": [(x, y) for y, row in enumerate(padded)
+                          for x, tile in enumerate(row) if tile == "$"]}
+        return cls(width, len(padded), load_chunk, entities, **kwargs)
+
+    @classmethod
+    def from_level_file(cls, path: str, **kwargs) -> "ChunkedWorld":
+        """Builds a world from an editor level (.klvl, .json or legacy .py).
+
+        Solid editor blocks become ground tiles; the editor grid matches TILE_SIZE.
+        """
+        return cls.from_rows(level_format.load_level(path).to_rows(TILE_SIZE), **kwargs)
+
+    @classmethod
+    def open(cls, directory: str, **kwargs) -> "ChunkedWorld":
+        """Opens a world saved with save(); only the header is read up front."""
+        with open(os.path.join(directory, "world.json"), "r", encoding="utf-8") as f:
+            header = json.load(f)
+        chunk_tiles = header["chunk_tiles"]
+
+        def load_chunk(chunk_x, chunk_y):
+            path = os.path.join(directory, f"chunk_{chunk_x}_{chunk_y}.txt")
+            if not os.path.exists(path):
+                return []  # empty chunks are not written
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().split("\n")
+
+        entities = {symbol: [tuple(pos) for pos in positions]
+                    for symbol, positions in header.get("entities", {}).items()}
+        return cls(header["width"], header["height"], load_chunk, entities,
+                   chunk_tiles=chunk_tiles, **kwargs)
+
+    @staticmethod
+    def save(rows: List[str], directory: str, chunk_tiles: int = CHUNK_TILES):
+        """Writes a map in the chunked on-disk format."""
+        os.makedirs(directory, exist_ok=True)
+        world = ChunkedWorld.from_rows(rows, chunk_tiles=chunk_tiles)
+        for chunk_y in range(world.rows):
+            for chunk_x in range(world.cols):
+                chunk = world.load_chunk(chunk_x, chunk_y)
+                if not any(row.strip() for row in chunk):
+                    continue
+                with open(os.path.join(directory, f"chunk_{chunk_x}_{chunk_y}.txt"), "w", encoding="utf-8") as f:
+                    f.write("\n".join(chunk))
+        with open(os.path.join(directory, "world.json"), "w", encoding="utf-8") as f:
+            json.dump({"width": world.width, "height": world.height,
+                       "chunk_tiles": chunk_tiles, "entities": world.entities}, f)
+
+    def chunk(self, chunk_x: int, chunk_y: int) -> List[str]:
+        """Returns the rows of a chunk, loading it if needed."""
+        index = chunk_y * self.cols + chunk_x
+        chunk = self.chunks[index]
+        if chunk is None:
+            chunk = self.load_chunk(chunk_x, chunk_y)
+            # Pad short or missing rows so lookups never go out of range
+            chunk = [row.ljust(self.chunk_tiles) for row in chunk[:self.chunk_tiles]]
+            chunk += [" " * self.chunk_tiles] * (self.chunk_tiles - len(chunk))
+            self.chunks[index] = chunk
+            self.loaded[index] = None
+            self._evict()
+        else:
+            self.loaded.move_to_end(index)
+        return chunk
+
+    def tile_at(self, x: int, y: int) -> str:
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return " "
+        chunk_x, local_x = divmod(x, self.chunk_tiles)
+        chunk_y, local_y = divmod(y, self.chunk_tiles)
+        chunk = self.chunks[chunk_y * self.cols + chunk_x]
+        if chunk is None:
+            chunk = self.chunk(chunk_x, chunk_y)
+        return chunk[local_y][local_x]
+
+    def is_loaded(self, chunk_x: int, chunk_y: int) -> bool:
+        return self.chunks[chunk_y * self.cols + chunk_x] is not None
+
+    def stream(self, view: pygame.Rect, margin: int = STREAM_MARGIN):
+        """Loads the chunks around a view rect given in world pixels."""
+        chunk_px = self.chunk_tiles * TILE_SIZE
+        start_cx = max(0, view.left // chunk_px - margin)
+        start_cy = max(0, view.top // chunk_px - margin)
+        end_cx = min(self.cols - 1, view.right // chunk_px + margin)
+        end_cy = min(self.rows - 1, view.bottom // chunk_px + margin)
+        for chunk_y in range(start_cy, end_cy + 1):
+            for chunk_x in range(start_cx, end_cx + 1):
+                self.chunk(chunk_x, chunk_y)
+
+    def _evict(self):
+        while len(self.loaded) > self.max_chunks:
+            index, _ = self.loaded.popitem(last=False)
+            self.chunks[index] = None
+            chunk_y, chunk_x = divmod(index, self.cols)
+            for listener in self.evict_listeners:
+                listener(chunk_x, chunk_y)
+
+# Tileset coordinates of the non-animated tiles
+STATIC_TILES = {
+    "#": (0, 1),  # ground
+    "[": (1, 1),  # box
+    "]": (1, 1),  # box
+    "^": (3, 0),  # spikes
+}
+
+class StaticTileLayer:
+    """Pre-renders the static tiles of a world into cached chunk surfaces.
+
+    Each chunk is drawn once, the first time it becomes visible, so a frame
+    only costs a handful of chunk blits no matter how many tiles are on screen.
+    Surfaces are dropped together with the world chunks they were built from,
+    and the least recently drawn ones once they exceed TILE_SURFACE_BUDGET
+    (the visible chunks are always kept). Call invalidate() when the map changes.
+    """
+
+    def __init__(self, world: ChunkedWorld):
+        self.tiles = {symbol: get_tile(*pos) for symbol, pos in STATIC_TILES.items()}
+        self.chunks = OrderedDict()  # (chunk_x, chunk_y) -> Surface or None for empty chunks, in LRU order
+        self.world = None
+        self.invalidate(world)
+
+    def invalidate(self, world: Optional[ChunkedWorld] = None):
+        """Drops every cached chunk, optionally switching to a new world."""
+        if world is not None and world is not self.world:
+            if self.world is not None:
+                self.world.evict_listeners.remove(self._forget_chunk)
+            self.world = world
+            self.chunk_tiles = world.chunk_tiles
+            self.chunk_px = world.chunk_tiles * TILE_SIZE
+            self.max_chunks = max(1, TILE_SURFACE_BUDGET // (self.chunk_px * self.chunk_px * 4))
+            world.evict_listeners.append(self._forget_chunk)
+        self.chunks.clear()
+
+    def _forget_chunk(self, chunk_x: int, chunk_y: int):
+        self.chunks.pop((chunk_x, chunk_y), None)
+
+    def _build_chunk(self, chunk_x: int, chunk_y: int) -> Optional[pygame.Surface]:
+        chunk = None
+        for y, row in enumerate(self.world.chunk(chunk_x, chunk_y)):
+            for x, symbol in enumerate(row):
+                tile = self.tiles.get(symbol)
+                if tile is None:
+                    continue
+                if chunk is None:
+                    chunk = pygame.Surface((self.chunk_px, self.chunk_px), pygame.SRCALPHA).convert_alpha()
+                    profiler.count("surfaces")
+                chunk.blit(tile, (x * TILE_SIZE, y * TILE_SIZE))
+        return chunk
+
+    def draw(self, surface: pygame.Surface, offset_x: int, offset_y: int):
+        """Blits the chunks overlapping the surface, shifted by the camera offset."""
+        view_w, view_h = surface.get_size()
+        start_cx = max(0, -offset_x // self.chunk_px)
+        start_cy = max(0, -offset_y // self.chunk_px)
+        end_cx = min(self.world.cols - 1, (view_w - offset_x) // self.chunk_px)
+        end_cy = min(self.world.rows - 1, (view_h - offset_y) // self.chunk_px)
+
+        blits = 0
+        for cy in range(start_cy, end_cy + 1):
+            for cx in range(start_cx, end_cx + 1):
+                key = (cx, cy)
+                if key in self.chunks:
+                    self.chunks.move_to_end(key)
+                else:
+                    self.chunks[key] = self._build_chunk(cx, cy)
+                chunk = self.chunks[key]
+                if chunk is not None:
+                    surface.blit(chunk, (cx * self.chunk_px + offset_x, cy * self.chunk_px + offset_y))
+                    blits += 1
+        profiler.count("blits", blits)
+
+        # Empty chunks cost no pixels but are counted too, which keeps the bound simple
+        visible = max(0, end_cx - start_cx + 1) * max(0, end_cy - start_cy + 1)
+        while len(self.chunks) > max(self.max_chunks, visible):
+            self.chunks.popitem(last=False)
+
+
+def draw_level(tile_layer: StaticTileLayer, rubies: RubyField):
+    # Draw background (scaled to fit screen, cached between frames)
+    screen.blit(background_cache.get((SCREEN_WIDTH, SCREEN_HEIGHT)), (0, 0))
+    profiler.count("blits")
+    profiler.lap("background")
     
-    # Draw visible tiles
-    for y in range(start_y, end_y):
-        for x in range(start_x, end_x):
-            if y >= len(level_map) or x >= len(level_map[y]):
-                continue
-                
-            tile = level_map[y][x]
-            pos = (x * TILE_SIZE + camera.camera.x, 
-                  y * TILE_SIZE + camera.camera.y)
-            
-            if tile == "#":
-                screen.blit(get_tile(0, 1), pos)  # ground
-            elif tile == "[" or tile == "]":
-                screen.blit(get_tile(1, 1), pos)  # box
-            elif tile == "^":
-                screen.blit(get_tile(3, 0), pos)  # spikes
+    # Draw static tiles from the chunk cache
+    tile_layer.draw(screen, camera.camera.x, camera.camera.y)
+    profiler.lap("tiles")
     
     # Draw animated rubies
-    for ruby in rubies:
-        ruby.update(dt)
-        # Convert ruby position to screen coordinates
-        screen_x = ruby.x * TILE_SIZE + camera.camera.x
-        screen_y = ruby.y * TILE_SIZE + camera.camera.y
-        
-        # Only draw if visible
-        if (-TILE_SIZE <= screen_x <= SCREEN_WIDTH and 
-            -TILE_SIZE <= screen_y <= SCREEN_HEIGHT):
-            ruby.draw(screen)
-
-def find_ruby_positions() -> List[Tuple[int, int]]:
-    """Find all ruby positions in the level map."""
-    ruby_positions = []
-    for y, row in enumerate(level_map):
-        for x, tile in enumerate(row):
-            if tile == "$":
-                ruby_positions.append((x, y))
-    return ruby_positions
+    rubies.draw(screen, camera.camera.x, camera.camera.y)
+    profiler.lap("rubies")
+
+def find_ruby_positions(world: ChunkedWorld) -> List[Tuple[int, int]]:
+    """Find all ruby positions in the world."""
+    return list(world.entities.get("$", []))
 
 def handle_events():
+    global screen, SCREEN_WIDTH, SCREEN_HEIGHT
     for event in pygame.event.get():
         if event.type == pygame.QUIT:
             return False
+        elif event.type == pygame.VIDEORESIZE:
+            SCREEN_WIDTH, SCREEN_HEIGHT = event.w, event.h
+            screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT), pygame.RESIZABLE)
+            camera.width, camera.height = SCREEN_WIDTH, SCREEN_HEIGHT
         elif event.type == pygame.KEYDOWN:
             if event.key == pygame.K_ESCAPE:
                 return False
@@ -164,12 +641,14 @@ def handle_events():
                 camera.zoom = min(2.0, camera.zoom + 0.1)
             elif event.key == pygame.K_MINUS:
                 camera.zoom = max(0.5, camera.zoom - 0.1)
+            elif event.key == pygame.K_F3:
+                profiler.show_overlay = not profiler.show_overlay
     return True
 
-def update_camera():
+def update_camera(world: ChunkedWorld):
     # Simple auto-scroll to show the whole level
-    level_width = len(level_map[0]) * TILE_SIZE
-    level_height = len(level_map) * TILE_SIZE
+    level_width = world.width * TILE_SIZE
+    level_height = world.height * TILE_SIZE
     
     # Center camera on level
     target_x = (SCREEN_WIDTH // 2) - (level_width // 2)
@@ -180,46 +659,116 @@ def update_camera():
     camera.camera.y = int(target_y * camera.zoom)
 
 # Main game loop
-def main():
+def main(world_dir: Optional[str] = None, trace_path: Optional[str] = None,
+         dirty_rects: bool = False):
     clock = pygame.time.Clock()
     running = True
+    profiler.recording = trace_path is not None
+    
+    # Chunked worlds on disk are streamed in, otherwise use the built-in map
+    if world_dir and os.path.isfile(world_dir):
+        world = ChunkedWorld.from_level_file(world_dir)
+    elif world_dir:
+        world = ChunkedWorld.open(world_dir)
+    else:
+        world = ChunkedWorld.from_rows(level_map)
     
     # Create animated rubies
-    ruby_positions = find_ruby_positions()
-    rubies = [AnimatedRuby(x, y) for x, y in ruby_positions]
+    ruby_positions = find_ruby_positions(world)
+    rubies = RubyField(ruby_positions)
+    
+    # Static tiles are rendered once into chunks
+    tile_layer = StaticTileLayer(world)
+    update_camera(world)
+    
+    # HUD text is only re-rendered when the zoom changes
+    zoom_label = HudLabel("Zoom: {:.1f}x (Press + or - to adjust)", (10, 10))
     
-    # For tracking time between frames
-    last_time = pygame.time.get_ticks()
+    # Presents either the whole window or, in dirty-rect mode, changed regions
+    renderer = DirtyRenderer()
+    view_key = None
+    
+    accumulator = 0.0
     
     while running:
+        profiler.begin_frame()
+        
         # Handle events
         running = handle_events()
+        profiler.lap("events")
         
-        # Update camera
-        update_camera()
+        # Run as many fixed simulation ticks as the elapsed time covers;
+        # laps add up over the ticks of a frame
+        steps = 0
+        while accumulator >= SIM_STEP and steps < MAX_STEPS_PER_FRAME:
+            update_camera(world)
+            profiler.lap("update_camera")
+            rubies.update(SIM_STEP)
+            profiler.lap("animate")
+            accumulator -= SIM_STEP
+            steps += 1
+        if steps == MAX_STEPS_PER_FRAME:
+            accumulator = min(accumulator, SIM_STEP)
         
-        # Calculate delta time for smooth animation
-        current_time = pygame.time.get_ticks()
-        dt = (current_time - last_time) / 1000.0  # Convert to seconds
-        last_time = current_time
+        # Stream in the chunks around the camera
+        world.stream(pygame.Rect(-camera.camera.x, -camera.camera.y, SCREEN_WIDTH, SCREEN_HEIGHT))
+        profiler.lap("stream")
         
-        # Draw everything
-        draw_level(rubies, dt)
+        # Anything but animation changing forces a full redraw, including
+        # hiding the overlay, which would otherwise stay on screen
+        key = (camera.camera.topleft, screen.get_size(), camera.zoom, profiler.show_overlay)
+        if not dirty_rects or key != view_key or profiler.show_overlay:
+            renderer.invalidate()
+            view_key = key
         
-        # Display zoom level
-        font = pygame.font.Font(None, 36)
-        zoom_text = font.render(f"Zoom: {camera.zoom:.1f}x (Press + or - to adjust)", True, (255, 255, 255))
-        screen.blit(zoom_text, (10, 10))
+        if renderer.full:
+            # Draw everything
+            draw_level(tile_layer, rubies)
+            rubies.mark_drawn()
+            
+            # Display zoom level
+            zoom_label.draw(screen, camera.zoom)
+            
+            # Timings of the previous frame (F3)
+            if profiler.show_overlay:
+                profiler.draw(screen)
+        else:
+            # Repaint only rubies whose frame changed and a changed zoom label
+            for rect in rubies.changed_rects(screen, camera.camera.x, camera.camera.y):
+                renderer.mark(rect)
+            old_label = zoom_label.rect
+            if zoom_label.set(camera.zoom):
+                renderer.mark(old_label)
+                renderer.mark(zoom_label.rect)
+            
+            def draw_region():
+                draw_level(tile_layer, rubies)
+                zoom_label.draw(screen, camera.zoom)
+            renderer.redraw(screen, draw_region)
+        profiler.lap("hud")
         
         # Update the display
-        pygame.display.flip()
+        renderer.present()
+        profiler.lap("flip")
         
-        # Cap the frame rate
-        clock.tick(60)
+        # Cap the frame rate and measure the time the frame took
+        accumulator += min(clock.tick(MAX_FPS) / 1000.0, MAX_FRAME_TIME)
+        profiler.lap("tick")
+        profiler.end_frame()
+    
+    if trace_path:
+        profiler.export(trace_path)
     
     # Clean up
     pygame.quit()
     sys.exit()
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="KINRI - Level 1")
+    parser.add_argument("world_dir", nargs="?", help="chunked world directory or editor level file")
+    parser.add_argument("--trace", help="write per-frame timings to this .csv or .json file")
+    parser.add_argument("--dirty", action="store_true",
+                        help="present only changed regions instead of the whole window")
+    args = parser.parse_args()
+    main(args.world_dir, args.trace, args.dirty)
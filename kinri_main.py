@@ -3,6 +3,10 @@ import os
 import sys
 from pygame import *
 
+import level_format
+from levels import (HEADLESS, SIM_STEP, MAX_FRAME_TIME, MAX_STEPS_PER_FRAME,
+                    MAX_FPS)
+
 # Initialize Pygame
 pygame.init()
 
@@ -15,18 +19,118 @@ pygame.display.set_caption("KINRI Game")
 # Colors
 BLACK = (0, 0, 0)
 
+# Process-wide asset registry: (path, size, flip) -> Surface
+_image_cache = {}
+# Sprite sheet registry: (path, frame_count, size, flip) -> list of frames
+_sheet_cache = {}
+
+def load_image(path, size=None, flip=False):
+    """Loads an image once and returns the same Surface to every caller."""
+    key = (path, size, flip)
+    image = _image_cache.get(key)
+    if image is None:
+        if flip:
+            image = pygame.transform.flip(load_image(path, size), True, False)
+        elif size is not None:
+            image = pygame.transform.scale(load_image(path), size)
+        else:
+            try:
+                image = pygame.image.load(path).convert_alpha()
+            except FileNotFoundError:
+                if not HEADLESS:
+                    raise
+                # Without the art, headless runs get a magenta sheet of the same shape
+                image = pygame.Surface((32 * 12, 32), pygame.SRCALPHA).convert_alpha()
+                image.fill((255, 0, 255))
+        _image_cache[key] = image
+    return image
+
+def load_sheet(path, frame_count, size, flip=False):
+    """Cuts a horizontal sprite sheet into frames scaled to size, cached per process."""
+    key = (path, frame_count, size, flip)
+    frames = _sheet_cache.get(key)
+    if frames is None:
+        if flip:
+            frames = [pygame.transform.flip(f, True, False) for f in load_sheet(path, frame_count, size)]
+        else:
+            sheet = load_image(path)
+            sheet_width, sheet_height = sheet.get_size()
+            frame_width = sheet_width // frame_count
+            frames = [
+                pygame.transform.scale(sheet.subsurface((i * frame_width, 0, frame_width, sheet_height)), size)
+                for i in range(frame_count)
+            ]
+        _sheet_cache[key] = frames
+    return frames
+
+# Tile settings
+TILE_SIZE = 64
+SOLID_TILES = "#[]"  # ground and box cells block movement
+
+class TileGrid:
+    """Spatial hash of solid cells used for collisions.
+
+    Collision checks only look at the few cells a rect overlaps, so their cost
+    does not depend on how many solid tiles the level has.
+    """
+
+    def __init__(self, level_rows=(), tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.cells = set()  # (column, row) of every solid cell
+        for y, row in enumerate(level_rows):
+            for x, tile in enumerate(row):
+                if tile in SOLID_TILES:
+                    self.cells.add((x, y))
+
+    @classmethod
+    def from_rects(cls, rects, tile_size=TILE_SIZE):
+        """Builds a grid from a list of barrier rects (done once, not per tick)."""
+        grid = cls(tile_size=tile_size)
+        for rect in rects:
+            grid.add_rect(rect)
+        return grid
+
+    @classmethod
+    def from_level_file(cls, path, tile_size=TILE_SIZE):
+        """Builds a grid from a .klvl/.json/.py level saved by the editor."""
+        return cls(level_format.load_level(path).to_rows(tile_size), tile_size)
+
+    def add_rect(self, rect):
+        """Marks every cell covered by a barrier rect as solid."""
+        for cell in self._cells_under(rect):
+            self.cells.add(cell)
+
+    def _cells_under(self, rect):
+        size = self.tile_size
+        for row in range(rect.top // size, (rect.bottom - 1) // size + 1):
+            for col in range(rect.left // size, (rect.right - 1) // size + 1):
+                yield col, row
+
+    def collisions(self, rect):
+        """Returns the rects of the solid cells that overlap rect."""
+        size = self.tile_size
+        return [pygame.Rect(col * size, row * size, size, size)
+                for col, row in self._cells_under(rect) if (col, row) in self.cells]
+
 class GameSprite(pygame.sprite.Sprite):
-    def __init__(self, player_image, player_x, player_y, size_x, size_y):
+    def __init__(self, player_image, player_x, player_y, size_x, size_y, player_image_hover=None):
         pygame.sprite.Sprite.__init__(self)
-        self.image_normal = pygame.transform.scale(pygame.image.load(player_image), (size_x, size_y))
+        self.image_normal = load_image(player_image, (size_x, size_y))
+        # Hover image is prepared once up front, never inside update()
+        if player_image_hover:
+            self.image_hover = load_image(player_image_hover, (size_x, size_y))
+        else:
+            self.image_hover = self.image_normal
         self.image = self.image_normal
         self.rect = self.image.get_rect()
         self.rect.x = player_x
         self.rect.y = player_y
     
-    def update(self, mouse_pos, player_image_hover, size_x, size_y):
+    def update(self, mouse_pos, player_image_hover=None, size_x=None, size_y=None):
+        if player_image_hover:
+            # Registry hit after the first call, so no disk access per frame
+            self.image_hover = load_image(player_image_hover, (size_x or self.rect.width, size_y or self.rect.height))
         if self.rect.collidepoint(mouse_pos):
-            self.image_hover = pygame.transform.scale(pygame.image.load(player_image_hover), (size_x, size_y))
             self.image = self.image_hover
         else:
             self.image = self.image_normal
@@ -34,6 +138,41 @@ class GameSprite(pygame.sprite.Sprite):
     def reset(self):
         screen.blit(self.image, (self.rect.x, self.rect.y))
 
+class Button(GameSprite):
+    """Menu button with normal/hover/pressed images prepared at creation time."""
+
+    def __init__(self, image, image_hover, x, y, size_x, size_y, image_pressed=None, on_click=None):
+        super().__init__(image, x, y, size_x, size_y, image_hover)
+        self.images = {
+            "normal": self.image_normal,
+            "hover": self.image_hover,
+            "pressed": load_image(image_pressed, (size_x, size_y)) if image_pressed else self.image_hover,
+        }
+        self.state = "normal"
+        self.on_click = on_click
+
+    def set_state(self, state):
+        self.state = state
+        self.image = self.images[state]
+
+    def handle_event(self, event):
+        """Moves between normal/hover/pressed and fires on_click on release."""
+        if event.type == pygame.MOUSEMOTION:
+            if self.state != "pressed":
+                self.set_state("hover" if self.rect.collidepoint(event.pos) else "normal")
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+            if self.rect.collidepoint(event.pos):
+                self.set_state("pressed")
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+            inside = self.rect.collidepoint(event.pos)
+            if self.state == "pressed" and inside and self.on_click:
+                self.on_click()
+            self.set_state("hover" if inside else "normal")
+
+    def update(self, mouse_pos, *args):
+        if self.state != "pressed":
+            self.set_state("hover" if self.rect.collidepoint(mouse_pos) else "normal")
+
 class Player(GameSprite):
     def __init__(self, player_image, player_x, player_y, size_x, size_y, player_x_speed, player_y_speed):
         super().__init__(player_image, player_x, player_y, size_x, size_y)
@@ -45,44 +184,33 @@ class Player(GameSprite):
         self.jump_power = -15
         self.gravity = 0.8
         self.on_ground = False
+        # Position before the last simulation tick, for interpolated drawing
+        self.prev_x = self.rect.x
+        self.prev_y = self.rect.y
         self.load_animation()
         self.load_jump_fall_images()
 
     def load_animation(self):
-        # Load run animation
-        sheet_right = pygame.image.load("Main Characters\\q\\Run.png").convert_alpha()
-        sheet_width, sheet_height = sheet_right.get_size()
-        frame_width = sheet_width // 12
-        frame_height = sheet_height
-        self.frames_right = [
-            pygame.transform.scale(sheet_right.subsurface((i * frame_width, 0, frame_width, frame_height)), (192, 192))
-            for i in range(12)
-        ]
-        self.frames_left = [pygame.transform.flip(f, True, False) for f in self.frames_right]
+        # Load run animation (shared between all players)
+        self.frames_right = load_sheet("Main Characters\\q\\Run.png", 12, (192, 192))
+        self.frames_left = load_sheet("Main Characters\\q\\Run.png", 12, (192, 192), flip=True)
         
         # Load idle animation
-        idle_sheet = pygame.image.load("Main Characters\\q\\Idle.png").convert_alpha()
-        idle_width, idle_height = idle_sheet.get_size()
-        idle_frame_width = idle_width // 11  # Assuming 11 frames in idle animation
-        self.idle_frames_right = [
-            pygame.transform.scale(idle_sheet.subsurface((i * idle_frame_width, 0, idle_frame_width, idle_height)), (192, 192))
-            for i in range(11)
-        ]
-        self.idle_frames_left = [pygame.transform.flip(f, True, False) for f in self.idle_frames_right]
+        # Assuming 11 frames in idle animation
+        self.idle_frames_right = load_sheet("Main Characters\\q\\Idle.png", 11, (192, 192))
+        self.idle_frames_left = load_sheet("Main Characters\\q\\Idle.png", 11, (192, 192), flip=True)
         
         self.animation_frames = self.idle_frames_right  # Start with idle animation
         self.is_moving = False
         
     def load_jump_fall_images(self):
         # Load jump image
-        jump_img = pygame.image.load("Main Characters\\q\\Jump.png").convert_alpha()
-        self.jump_img_right = pygame.transform.scale(jump_img, (192, 192))
-        self.jump_img_left = pygame.transform.flip(self.jump_img_right, True, False)
+        self.jump_img_right = load_image("Main Characters\\q\\Jump.png", (192, 192))
+        self.jump_img_left = load_image("Main Characters\\q\\Jump.png", (192, 192), flip=True)
         
         # Load fall image
-        fall_img = pygame.image.load("Main Characters\\q\\Fall.png").convert_alpha()
-        self.fall_img_right = pygame.transform.scale(fall_img, (192, 192))
-        self.fall_img_left = pygame.transform.flip(self.fall_img_right, True, False)
+        self.fall_img_right = load_image("Main Characters\\q\\Fall.png", (192, 192))
+        self.fall_img_left = load_image("Main Characters\\q\\Fall.png", (192, 192), flip=True)
 
     def update_animation(self):
         self.frame_index += 0.2
@@ -95,7 +223,21 @@ class Player(GameSprite):
             self.y_speed = self.jump_power
             self.on_ground = False
 
-    def update(self, barriers):
+    def reset(self, alpha=1.0):
+        """Draws the player between its last two simulation positions."""
+        x = self.prev_x + (self.rect.x - self.prev_x) * alpha
+        y = self.prev_y + (self.rect.y - self.prev_y) * alpha
+        return screen.blit(self.image, (round(x), round(y)))
+
+    def update(self, barriers, floor=None):
+        """Advances the player by one simulation tick.
+
+        barriers is a TileGrid built once per level (see TileGrid.from_rects
+        for plain lists of rects). floor is an optional fixed ground line in
+        screen pixels, used when there is no level to stand on.
+        """
+        self.prev_x = self.rect.x
+        self.prev_y = self.rect.y
         keys = pygame.key.get_pressed()
         
         # Handle jump
@@ -123,14 +265,37 @@ class Player(GameSprite):
         # Apply gravity
         self.y_speed += self.gravity
         
-        # Update position based on speed
+        # Move horizontally and resolve tile collisions
         self.rect.x += self.x_speed
+        for tile in barriers.collisions(self.rect):
+            if self.x_speed > 0:
+                self.rect.right = tile.left
+            elif self.x_speed < 0:
+                self.rect.left = tile.right
+        
+        # Move vertically and resolve tile collisions
         self.rect.y += self.y_speed
+        landed = False
+        for tile in barriers.collisions(self.rect):
+            if self.y_speed > 0:
+                self.rect.bottom = tile.top
+                landed = True
+            elif self.y_speed < 0:
+                self.rect.top = tile.bottom
+            self.y_speed = 0
+        # Standing still, gravity is under a pixel per tick and Rect drops the
+        # fraction, so a solid cell right under the feet also counts as ground
+        if not landed and self.y_speed >= 0 and barriers.collisions(self.rect.move(0, 1)):
+            self.y_speed = 0
+            landed = True
         
         # Check for ground collision
-        if self.rect.bottom >= WINDOW_HEIGHT - 50:  # 50 is ground level
-            self.rect.bottom = WINDOW_HEIGHT - 50
+        if floor is not None and self.rect.bottom >= floor:
+            self.rect.bottom = floor
             self.y_speed = 0
+            landed = True
+        
+        if landed:
             self.on_ground = True
             # Reset to run animation when on ground
             if self.direction == "right":
@@ -170,41 +335,79 @@ class Player(GameSprite):
         # Update animation
         self.update_animation()
 
-# Create player instance after class definitions
-player = Player("Main Characters\\q\\Run.png", 
-                WINDOW_WIDTH // 2 - 96,  # Center horizontally (192x192 sprite)
-                WINDOW_HEIGHT // 2 - 96,  # Center vertically
-                192, 192, 0, 0)  # Size and initial speed
-
-# Main game loop
-running = True
-clock = pygame.time.Clock()
-FPS = 60
-
-while running:
-    # Event handling
-    for event in pygame.event.get():
-        if event.type == pygame.QUIT:
-            running = False
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                running = False
-    
-    # Fill the screen with black
-    screen.fill(BLACK)
+def main(level_path=None, dirty_rects=False):
+    """Runs the game loop.
+
+    With dirty_rects only the player's old and new areas are repainted and
+    presented instead of the whole window.
+    """
+    # Create player instance after class definitions
+    player = Player("Main Characters\\q\\Run.png", 
+                    WINDOW_WIDTH // 2 - 96,  # Center horizontally (192x192 sprite)
+                    WINDOW_HEIGHT // 2 - 96,  # Center vertically
+                    192, 192, 0, 0)  # Size and initial speed
     
-    # Update player
-    player.update([])  # Pass empty barriers list for now
+    # Solid tiles for collisions come from a level file if given. Without one
+    # nothing is drawn, so there are no tiles and the player stands on a floor.
+    if level_path:
+        barriers = TileGrid.from_level_file(level_path)
+        floor = None
+    else:
+        barriers = TileGrid()
+        floor = WINDOW_HEIGHT - 50  # 50 is ground level
     
-    # Draw player
-    player.reset()
+    # Main game loop
+    running = True
+    clock = pygame.time.Clock()
+    accumulator = 0.0
+    drawn_rect = None  # where the player was presented last frame
     
-    # Update the display
-    pygame.display.flip()
+    while running:
+        # Event handling
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_ESCAPE:
+                    running = False
+        
+        # Run as many fixed simulation ticks as the elapsed time covers
+        steps = 0
+        while accumulator >= SIM_STEP and steps < MAX_STEPS_PER_FRAME:
+            player.update(barriers, floor)
+            accumulator -= SIM_STEP
+            steps += 1
+        if steps == MAX_STEPS_PER_FRAME:
+            accumulator = min(accumulator, SIM_STEP)
+        
+        if dirty_rects and drawn_rect is not None:
+            # Erase the old player area, draw the new one and present both
+            screen.fill(BLACK, drawn_rect)
+            new_rect = player.reset(accumulator / SIM_STEP)
+            pygame.display.update([drawn_rect, new_rect])
+            drawn_rect = new_rect
+        else:
+            # Fill the screen with black
+            screen.fill(BLACK)
+            
+            # Draw player, interpolated between the last two ticks
+            drawn_rect = player.reset(accumulator / SIM_STEP)
+            
+            # Update the display
+            pygame.display.flip()
+        
+        # Cap the frame rate and measure the time the frame took
+        accumulator += min(clock.tick(MAX_FPS) / 1000.0, MAX_FRAME_TIME)
     
-    # Cap the frame rate
-    clock.tick(FPS)
+    # Quit Pygame
+    pygame.quit()
+    sys.exit()
 
-# Quit Pygame
-pygame.quit()
-sys.exit()
\ No newline at end of file
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="KINRI Game")
+    parser.add_argument("level_path", nargs="?", help="level file saved by the editor")
+    parser.add_argument("--dirty", action="store_true",
+                        help="present only changed regions instead of the whole window")
+    args = parser.parse_args()
+    main(args.level_path, args.dirty)
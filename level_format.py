@@ -0,0 +1,299 @@
+"""Level file format shared by the level editor and the game.
+
+A level is a background image name plus a list of placed blocks. Blocks are
+stored column-wise: x, y, palette index and solid flag arrays, with block
+names kept once in a palette. Names are paths relative to the level file:
+asset references ("assets/<sha256>.png", see asset_store) or plain file
+names in older levels.
+
+Binary layout (.klvl, little-endian):
+
+    magic      4s   b"KLVL"
+    version    u16
+    count      u32  number of blocks
+    background str  (u16 length + UTF-8, 0xFFFF for no background, so
+                    strings are at most 0xFFFE bytes)
+    palette    u16 count, then that many str
+    xs         count * i32
+    ys         count * i32
+    blocks     count * u16  index into the palette
+    solid      count * u8
+
+Files ending in .json hold the same columns as JSON for debugging. A
+directory of .klvl files (the editor's chunked autosave) loads as one level.
+Writes go to a temporary file that is renamed over the target, so a crash
+never leaves a half-written level. Old level_data/*.py files can be read
+(without executing them) and converted.
+
+    python level_format.py convert level_data/*.py
+"""
+import ast
+import json
+import os
+import struct
+import sys
+import tempfile
+from array import array
+
+MAGIC = b"KLVL"
+VERSION = 1
+NO_STRING = 0xFFFF
+EXTENSION = ".klvl"
+
+# mkstemp creates owner-only files; new files get the mode open() would give them.
+# The umask can only be read by setting it, so that is done once, at import
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+class Level:
+    """A background name plus columnar arrays of placed blocks."""
+
+    def __init__(self, background=None, palette=None, xs=None, ys=None, blocks=None, solid=None):
+        self.background = background
+        self.palette = list(palette or [])
+        self.xs = xs if xs is not None else array("i")
+        self.ys = ys if ys is not None else array("i")
+        self.blocks = blocks if blocks is not None else array("H")
+        self.solid = solid if solid is not None else array("B")
+
+    @classmethod
+    def from_objects(cls, objects, background=None):
+        """Builds a level from dicts with x, y, block and optional solid keys."""
+        level = cls(background)
+        index = {}
+        for obj in objects:
+            name = obj["block"]
+            if name not in index:
+                index[name] = len(level.palette)
+                level.palette.append(name)
+            level.xs.append(int(obj["x"]))
+            level.ys.append(int(obj["y"]))
+            level.blocks.append(index[name])
+            level.solid.append(1 if obj.get("solid", True) else 0)
+        return level
+
+    def __len__(self):
+        return len(self.xs)
+
+    def objects(self):
+        """Yields the blocks as dicts, in the shape of the old .py files."""
+        for x, y, block, solid in zip(self.xs, self.ys, self.blocks, self.solid):
+            yield {"x": x, "y": y, "block": self.palette[block], "solid": bool(solid)}
+
+    def to_rows(self, cell_size, symbol="#"):
+        """Rasterizes solid blocks into level_map-style rows of symbols."""
+        cells = {(x // cell_size, y // cell_size)
+                 for x, y, solid in zip(self.xs, self.ys, self.solid) if solid}
+        if not cells:
+            return []
+        width = max(cx for cx, _ in cells) + 1
+        height = max(cy for _, cy in cells) + 1
+        rows = [[" "] * width for _ in range(height)]
+        for cx, cy in cells:
+            if cx >= 0 and cy >= 0:
+                rows[cy][cx] = symbol
+        return ["".join(row) for row in rows]
+
+
+def _check(level):
+    """Raises ValueError unless the columns line up and every block is in the palette."""
+    count = len(level.xs)
+    if not len(level.ys) == len(level.blocks) == len(level.solid) == count:
+        raise ValueError("level columns have different lengths")
+    if count and max(level.blocks) >= len(level.palette):
+        raise ValueError(f"block index {max(level.blocks)} outside a palette of {len(level.palette)}")
+    return level
+
+
+def _pack_str(value):
+    if value is None:
+        return struct.pack("<H", NO_STRING)
+    data = value.encode("utf-8")
+    # NO_STRING itself is the "no string" marker, so the longest name is one byte shorter
+    if len(data) >= NO_STRING:
+        raise ValueError(f"name too long for a level file ({len(data)} bytes): {value[:40]}...")
+    return struct.pack("<H", len(data)) + data
+
+
+def _unpack_str(buf, offset):
+    (length,) = struct.unpack_from("<H", buf, offset)
+    offset += 2
+    if length == NO_STRING:
+        return None, offset
+    if offset + length > len(buf):
+        raise ValueError("truncated level file")
+    return bytes(buf[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+def dumps(level):
+    """Serializes a level to the binary format."""
+    parts = [MAGIC, struct.pack("<HI", VERSION, len(level)), _pack_str(level.background),
+             struct.pack("<H", len(level.palette))]
+    parts += [_pack_str(name) for name in level.palette]
+    for column in (level.xs, level.ys, level.blocks, level.solid):
+        parts.append(_little_endian(column).tobytes())
+    return b"".join(parts)
+
+
+def loads(buf):
+    """Parses the binary format from a bytes-like object.
+
+    Raises ValueError for anything that is not a complete level file.
+    """
+    buf = memoryview(buf)
+    if bytes(buf[:4]) != MAGIC:
+        raise ValueError("not a KINRI level file")
+    try:
+        version, count = struct.unpack_from("<HI", buf, 4)
+        if version != VERSION:
+            raise ValueError(f"unsupported level format version {version}")
+        background, offset = _unpack_str(buf, 10)
+        (palette_len,) = struct.unpack_from("<H", buf, offset)
+        offset += 2
+        palette = []
+        for _ in range(palette_len):
+            name, offset = _unpack_str(buf, offset)
+            palette.append(name)
+    except struct.error:
+        raise ValueError("truncated level file") from None
+
+    columns = []
+    for typecode in ("i", "i", "H", "B"):
+        column = array(typecode)
+        size = count * column.itemsize
+        if offset + size > len(buf):
+            raise ValueError("truncated level file")
+        column.frombytes(buf[offset:offset + size])
+        offset += size
+        columns.append(_little_endian(column))
+    if offset != len(buf):
+        raise ValueError(f"{len(buf) - offset} unexpected bytes after the level data")
+    return _check(Level(background, palette, *columns))
+
+
+def merge_levels(levels):
+    """Concatenates levels into one, merging their palettes."""
+    merged = Level()
+    index = {}
+    for level in levels:
+        if merged.background is None:
+            merged.background = level.background
+        remap = []
+        for name in level.palette:
+            if name not in index:
+                index[name] = len(merged.palette)
+                merged.palette.append(name)
+            remap.append(index[name])
+        merged.xs.extend(level.xs)
+        merged.ys.extend(level.ys)
+        merged.blocks.extend(array("H", [remap[block] for block in level.blocks]))
+        merged.solid.extend(level.solid)
+    return merged
+
+
+def _load_json(path):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != VERSION:
+        raise ValueError(f"unsupported level format version {data.get('version')}")
+    try:
+        level = Level(data.get("background"), data["palette"], array("i", data["x"]), array("i", data["y"]),
+                      array("H", data["block"]), array("B", data["solid"]))
+    except (KeyError, TypeError, OverflowError) as e:
+        raise ValueError(f"malformed level file: {e!r}") from None
+    return _check(level)
+
+
+def _load_legacy(path):
+    """Reads an old editor .py level by evaluating its literals, never the code."""
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    values = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            values[node.targets[0].id] = ast.literal_eval(node.value)
+    return Level.from_objects(values.get("objects", []), values.get("background_image"))
+
+
+def load_level(path):
+    """Loads a .klvl, .json or legacy .py level file, or a directory of .klvl files."""
+    if os.path.isdir(path):
+        return merge_levels(load_level(os.path.join(path, name))
+                            for name in sorted(os.listdir(path)) if name.endswith(EXTENSION))
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".py":
+        return _load_legacy(path)
+    if extension == ".json":
+        return _load_json(path)
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def _encode(path, level):
+    if path.lower().endswith(".json"):
+        data = {
+            "version": VERSION,
+            "background": level.background,
+            "palette": level.palette,
+            "x": level.xs.tolist(),
+            "y": level.ys.tolist(),
+            "block": level.blocks.tolist(),
+            "solid": level.solid.tolist(),
+        }
+        return json.dumps(data, ensure_ascii=False, indent=1).encode("utf-8")
+    return dumps(level)
+
+
+def write_atomic(path, write):
+    """Writes a file through write(f) into a temp file beside it, then renames it into place.
+
+    The temp file is synced before the rename, so after a crash path holds
+    either its old content or the complete new one. Every call gets its own
+    temp name: a save and an autosave thread may write the same file at once.
+    The file keeps the mode of the one it replaces; new files follow the umask.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def save_level(path, level):
+    """Writes a level atomically; .json paths get the JSON form, anything else binary."""
+    write_atomic(path, lambda f: f.write(_encode(path, level)))
+
+
+def convert_legacy_level(py_path, out_path=None):
+    """Converts an old .py level into the binary format next to it."""
+    out_path = out_path or os.path.splitext(py_path)[0] + EXTENSION
+    save_level(out_path, _load_legacy(py_path))
+    return out_path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "convert":
+        print("usage: python level_format.py convert LEVEL.py [LEVEL.py ...]")
+        sys.exit(2)
+    for py_path in sys.argv[2:]:
+        print(f"{py_path} -> {convert_legacy_level(py_path)}")
@@ -0,0 +1,47 @@
+"""Built-in level maps and settings shared by the game modules.
+
+Kept free of pygame and display setup so any module can import a map.
+Import it before pygame is initialized: headless mode picks the SDL
+video driver here.
+"""
+import os
+
+# Headless mode (KINRI_HEADLESS=1) renders offscreen through SDL's dummy
+# video driver, so the game can be driven on machines without a display
+HEADLESS = os.environ.get("KINRI_HEADLESS") == "1"
+if HEADLESS:
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+# Timing: the simulation runs at a fixed rate, rendering as fast as allowed.
+# Player speeds, gravity and animation steps are per simulation tick.
+SIM_RATE = 60
+SIM_STEP = 1.0 / SIM_RATE
+MAX_FRAME_TIME = 0.25  # longer stalls are dropped instead of replayed
+MAX_STEPS_PER_FRAME = 5
+MAX_FPS = 144  # 0 removes the render cap
+
+# Level map (manually created)
+level_map = [
+    "                                                                                ",
+    "                                                                                ",
+    "                            $$$                                                 ",
+    "      [ ]                  #####                  [ ]                           ",
+    "     ####                ##     ##               ####                           ",
+    "    ##                  ##       ##             ##                              ",
+    "   ##                  ##         ##           ##                               ",
+    "  ##                  ##           ##         ##                                ",
+    " ##                  ##             ##       ##                                 ",
+    "##                  ##               ##     ##                                  ",
+    "                    ##               ##     ##                                  ",
+    "                    ##               ##     ##                                  ",
+    "                    #################       #################                   ",
+    "                                                                                ",
+    "                                                                                "
+]
+
+# Symbols:
+# '#' - ground
+# '[' - box start
+# ']' - box end
+# '$' - ruby
+# '^' - spikes